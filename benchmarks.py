@@ -0,0 +1,400 @@
+"""
+License: GPL3
+
+Benchmarks for the hot path of each module.
+
+    python benchmarks.py run -o baseline.json
+    python benchmarks.py run -o current.json
+    python benchmarks.py compare baseline.json current.json --threshold 0.1
+
+'run' times every workload (perf_counter_ns, best of --repeat runs) and
+measures its peak memory in one extra run with tracemalloc, then writes the
+results as JSON. Workloads of modules that cannot be imported (for example
+when plotly is not installed) are recorded as skipped. 'compare' prints the
+change of every workload in both files and exits with 1 if any of them got
+slower or used more memory than the threshold allows.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from tempfile import TemporaryDirectory
+from time import perf_counter_ns
+from typing import Callable, NamedTuple
+
+# Peak memory has to grow by more than this to be a regression, so that
+# workloads which barely allocate do not fail on a few bytes.
+_MIN_MEMORY_GROWTH = 64 * 1024
+
+
+class Workload(NamedTuple):
+    """A benchmark of one hot path. 'make' is called with each dict in
+    'params' before every run, it does the setup (which is not timed) and
+    returns the function that is timed.
+    """
+    module: str
+    name: str
+    make: Callable[..., Callable[[], any]]
+    params: list[dict[str, any], ...]
+
+
+def _prime_index(index: int) -> Callable[[], any]:
+    from primes import prime_index
+    return lambda: prime_index(index)
+
+
+def _prime_factors(stop: int) -> Callable[[], any]:
+    from primes import Primes
+
+    def run() -> None:
+        for number in range(2, stop):
+            Primes.prime_factors(number)
+    return run
+
+
+def _sequence_func(values: list) -> Decimal:
+    return (Decimal(2 ** (1 + 3 * (len(values) + 1))) **
+            Decimal(1 / (len(values) + 1)))
+
+
+def _msequence_run(iterations: int) -> Callable[[], any]:
+    from sequences import MSequence
+    sequence = MSequence(lambda values: values.append(_sequence_func(values)),
+                         [], True)
+    return lambda: sequence.run(iterations)
+
+
+def _msequence_analyse(iterations: int) -> Callable[[], any]:
+    from sequences import MSequence
+    sequence = MSequence(lambda values: values.append(_sequence_func(values)),
+                         [], True)
+    sequence.run(iterations)
+    return sequence.analyse
+
+
+def _msequence_np_run(iterations: int) -> Callable[[], any]:
+    import numpy as np
+    from sequences_np import MSequence
+    sequence = MSequence(_sequence_func, np.array([], dtype=Decimal), True)
+    return lambda: sequence.run(iterations)
+
+
+def _msequence_np_analyse(iterations: int) -> Callable[[], any]:
+    import numpy as np
+    from sequences_np import MSequence
+    sequence = MSequence(_sequence_func, np.array([], dtype=Decimal), True)
+    sequence.run(iterations)
+    return sequence.analyse
+
+
+@lru_cache(maxsize=None)
+def _temp_directory() -> TemporaryDirectory:
+    """The directory for the benchmark files, removed when Python exits."""
+    return TemporaryDirectory()
+
+
+@lru_cache(maxsize=None)
+def _csv_file(rows: int, columns: int) -> str:
+    """Writes a csv of rows x columns numbers once and returns its name."""
+    filename = os.path.join(_temp_directory().name,
+                            f"bench_{rows}_{columns}.csv")
+    with open(filename, "w") as csv:
+        csv.write(",".join(f"column {col}" for col in range(columns)) + "\n")
+        for row in range(rows):
+            csv.write(",".join(str(row * col) for col in range(columns))
+                      + "\n")
+    return filename
+
+
+def _csv_reader(rows: int, columns: int = 8) -> Callable[[], any]:
+    from simple_csv_parser import FileParser
+    return FileParser(_csv_file(rows, columns)).csv_reader
+
+
+def _table_render(rows: int, columns: int = 6) -> Callable[[], any]:
+    from console_table import TableOut
+    headers = [f"column {col}" for col in range(columns)]
+    table_rows = [[row * col for col in range(columns)]
+                  for row in range(rows)]
+
+    def run() -> None:
+        TableOut(headers, table_rows, 1, "bench").write_table(io.StringIO())
+    return run
+
+
+def _range_iteration(length: int) -> Callable[[], any]:
+    from range_py import Range
+    float_range = Range(0, length / 10, 0.1)
+
+    def run() -> None:
+        for _ in float_range:
+            pass
+    return run
+
+
+def _delete_all_instances(size: int) -> Callable[[], any]:
+    from list_utils import ListUtils
+    lists = ListUtils([value % 10 for value in range(size)])
+    return lambda: lists.delete_all_instances(3)
+
+
+def _delete_all_matching(size: int, predicate: bool) -> Callable[[], any]:
+    from list_utils import ListUtils
+    lists = ListUtils([value % 10 for value in range(size)])
+    if predicate:
+        return lambda: lists.delete_all_matching(
+            predicate=lambda value: value == 3)
+    return lambda: lists.delete_all_matching(values={3})
+
+
+def _add_key_value_list(size: int, condition: int) -> Callable[[], any]:
+    from dict_utils import DictUtils
+    dictionary = (dict() if condition == 0 else
+                  {key: [key] for key in range(0, size, 2)})
+    key_val = [(key, key) for key in range(size)]
+    return lambda: DictUtils(dictionary).add_key_value_list(key_val,
+                                                            condition)
+
+
+def _dbg_print(records: int, background: bool, console_log: bool,
+               file_log: bool) -> Callable[[], any]:
+    """Opens a log, logs 'records' records and closes it. The console
+    output goes to os.devnull so the terminal is not measured, which is why
+    opening the log (and its writer thread) is timed too.
+    """
+    from debug_log import DbgLog
+
+    def run() -> None:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            log = DbgLog("dbg_benchmark", 0, console_log, file_log,
+                         background=background, queue_size=records + 1)
+            for i in range(records):
+                log.dbg_print("Hello World", i)
+            log.dbg_close()
+        if file_log:
+            log.dbg_delete()
+    return run
+
+
+WORKLOADS = [
+    Workload("primes", "prime_index", _prime_index,
+             [{"index": 300}, {"index": 1500}]),
+    Workload("primes", "prime_factors", _prime_factors,
+             [{"stop": 300}, {"stop": 1000}]),
+    Workload("sequences", "MSequence.run", _msequence_run,
+             [{"iterations": 100}, {"iterations": 400}]),
+    Workload("sequences", "MSequence.analyse", _msequence_analyse,
+             [{"iterations": 100}, {"iterations": 400}]),
+    Workload("sequences_np", "MSequence.run", _msequence_np_run,
+             [{"iterations": 100}, {"iterations": 400}]),
+    Workload("sequences_np", "MSequence.analyse", _msequence_np_analyse,
+             [{"iterations": 100}, {"iterations": 400}]),
+    Workload("simple_csv_parser", "csv_reader", _csv_reader,
+             [{"rows": 10_000}, {"rows": 100_000}]),
+    Workload("console_table", "TableOut.write_table", _table_render,
+             [{"rows": 1_000}, {"rows": 20_000}]),
+    Workload("range_py", "Range iteration", _range_iteration,
+             [{"length": 10_000}, {"length": 200_000}]),
+    Workload("list_utils", "delete_all_instances", _delete_all_instances,
+             [{"size": 100_000}, {"size": 2_000_000}]),
+    Workload("list_utils", "delete_all_matching", _delete_all_matching,
+             [{"size": 100_000, "predicate": predicate}
+              for predicate in (False, True)] +
+             [{"size": 2_000_000, "predicate": predicate}
+              for predicate in (False, True)]),
+    Workload("debug_log", "DbgLog.dbg_print", _dbg_print,
+             [{"records": 100_000, "background": background,
+               "console_log": console_log, "file_log": file_log}
+              for background in (False, True)
+              for console_log in (False, True)
+              for file_log in (False, True)]),
+    Workload("dict_utils", "add_key_value_list", _add_key_value_list,
+             [{"size": 100_000, "condition": condition}
+              for condition in range(5)] +
+             [{"size": 1_000_000, "condition": 3}]),
+]
+
+
+def _key(workload: Workload, params: dict[str, any]) -> str:
+    values = ", ".join(f"{name}={value}" for name, value in params.items())
+    return f"{workload.module}.{workload.name}[{values}]"
+
+
+def _measure(make: Callable[[], Callable[[], any]],
+             repeat: int) -> dict[str, any]:
+    """Times 'repeat' runs and then measures the peak memory of one more,
+    every run gets a fresh setup.
+    """
+    times = list()
+    for _ in range(repeat):
+        run = make()
+        gc.collect()
+        start = perf_counter_ns()
+        run()
+        times.append(perf_counter_ns() - start)
+        del run
+    run = make()
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "times_ns": times,
+        "min_ns": min(times),
+        "median_ns": int(statistics.median(times)),
+        "peak_bytes": peak,
+    }
+
+
+def run_benchmarks(repeat: int = 5, quick: bool = False,
+                   select: str | None = None, verbose: bool = True
+                   ) -> dict[str, any]:
+    """Runs the workloads and returns the results, 'quick' runs only the
+    first params of each workload and 'select' only the workloads whose key
+    contains it.
+    """
+    results = dict()
+    skipped = dict()
+    for workload in WORKLOADS:
+        for params in workload.params[:1] if quick else workload.params:
+            key = _key(workload, params)
+            if select is not None and select not in key:
+                continue
+            try:
+                result = _measure(lambda: workload.make(**params), repeat)
+            except ImportError as error:
+                skipped[key] = f"{type(error).__name__}: {error}"
+                if verbose:
+                    print(f"{key: <60} skipped, {error}")
+                continue
+            results[key] = {"module": workload.module,
+                            "workload": workload.name,
+                            "params": params} | result
+            if verbose:
+                print(f"{key: <60} {result['min_ns'] / 10 ** 6:>10.2f} ms "
+                      f"{result['peak_bytes'] / 2 ** 20:>9.2f} MiB")
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+def compare_results(baseline: dict[str, any], current: dict[str, any],
+                    threshold: float = 0.1,
+                    memory_threshold: float | None = None
+                    ) -> tuple[list[list[any, ...]], list[str]]:
+    """Compares the best time and the peak memory of every workload in both
+    results. Returns the rows of the comparison and the keys which are
+    more than threshold (a fraction, 0.1 is 10%) slower, or more than
+    memory_threshold bigger (defaults to threshold) and by more than
+    _MIN_MEMORY_GROWTH bytes.
+    """
+    if memory_threshold is None:
+        memory_threshold = threshold
+    rows = list()
+    regressions = list()
+    for key, now in current["results"].items():
+        before = baseline["results"].get(key)
+        if before is None:
+            rows.append([key, "-", f"{now['min_ns'] / 10 ** 6:.2f}", "-",
+                         "-", "new"])
+            continue
+        time_change = now["min_ns"] / max(before["min_ns"], 1) - 1
+        memory_change = now["peak_bytes"] / max(before["peak_bytes"], 1) - 1
+        memory_grown = (memory_change > memory_threshold and
+                        now["peak_bytes"] - before["peak_bytes"] >
+                        _MIN_MEMORY_GROWTH)
+        status = "ok"
+        if time_change > threshold or memory_grown:
+            status = "REGRESSION"
+            regressions.append(key)
+        elif time_change < -threshold:
+            status = "faster"
+        rows.append([key, f"{before['min_ns'] / 10 ** 6:.2f}",
+                     f"{now['min_ns'] / 10 ** 6:.2f}", f"{time_change:+.1%}",
+                     f"{memory_change:+.1%}", status])
+    for key, before in baseline["results"].items():
+        if key in current["results"]:
+            continue
+        reason = current.get("skipped", dict()).get(key, "not run")
+        rows.append([key, f"{before['min_ns'] / 10 ** 6:.2f}", "-", "-", "-",
+                     f"missing, {reason}"])
+    return rows, regressions
+
+
+def _read_json(filename: str) -> dict[str, any]:
+    with open(filename, "r") as file:
+        return json.load(file)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths "
+                                                 "of the modules.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", default=None,
+                            help="JSON file to write the results to")
+    run_parser.add_argument("-r", "--repeat", type=int, default=5,
+                            help="timed runs of each workload")
+    run_parser.add_argument("-q", "--quick", action="store_true",
+                            help="only the smallest params of each workload")
+    run_parser.add_argument("-k", "--select", default=None,
+                            help="only workloads whose name contains this")
+
+    compare_parser = commands.add_parser(
+        "compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("baseline", help="baseline results JSON")
+    compare_parser.add_argument("current", help="current results JSON")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                                help="allowed slowdown, 0.1 is 10%%")
+    compare_parser.add_argument("-m", "--memory-threshold", type=float,
+                                default=None,
+                                help="allowed peak memory growth, "
+                                     "defaults to --threshold")
+
+    commands.add_parser("list", help="list the workloads")
+
+    args = parser.parse_args(argv)
+    match args.command:
+        case "run":
+            results = run_benchmarks(args.repeat, args.quick, args.select)
+            if args.output is not None:
+                with open(args.output, "w") as file:
+                    json.dump(results, file, indent=2)
+            return 0
+        case "compare":
+            from console_table import TableOut
+            rows, regressions = compare_results(
+                _read_json(args.baseline), _read_json(args.current),
+                args.threshold, args.memory_threshold)
+            TableOut(["workload", "baseline ms", "current ms", "time",
+                      "peak memory", "status"], rows, 1,
+                     f"{len(regressions)} regressions").print_basic_table()
+            return 1 if regressions else 0
+        case "list":
+            for workload in WORKLOADS:
+                for params in workload.params:
+                    print(_key(workload, params))
+            return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,13 @@ Alexander Bürow - 13 October 2023
 License: GPL3
 """
 
+from collections.abc import Sequence
+from itertools import chain, islice, starmap
+from operator import itemgetter
+from typing import Iterable, Iterator, TextIO
+import sys
+
+
 class TableOut:
     def __init__(self, headers: list[any, ...], rows: list[list[any, ...]],
                  cell_x_padding: int, title: str | None):
@@ -19,6 +26,15 @@ class TableOut:
         self._rows = rows
         self._x_padding = cell_x_padding
         self._title = title
+        self._strings = None
+        self._widths = None
+        self._rows_owned = False
+        self._head = None
+        self._rendered = list()
+        self._rendered_widths = None
+        self._width_index = dict()
+        self._columns = None
+        self._rows_seen = None
 
         if any(len(self._headers) != len(row) for row in self._rows):
             raise ValueError("'headers' and 'rows' should have the same "
@@ -38,7 +54,7 @@ class TableOut:
 
         new_rows = list()
         for index, row in enumerate(self._rows):
-            new_rows.append(row + other._rows[index])
+            new_rows.append(list(row) + list(other._rows[index]))
 
         return TableOut(headers=self._headers + other._headers,
                         rows=new_rows,
@@ -55,6 +71,143 @@ class TableOut:
     def __str__(self):
         return "\n".join(self._make_basic_table())
 
+    @classmethod
+    def from_columns(cls, columns: dict[any, Sequence], cell_x_padding: int,
+                     title: str | None) -> "TableOut":
+        """Creates a TableOut from columns, e.g. FileParser.csv_reader
+            output or a dict of NumPy arrays, without building rows.
+
+        Each column is converted to strings in one go (a single astype call
+        for NumPy arrays) and the rows are rendered by zipping the string
+        columns.
+
+        :param columns: The header of each column mapped to its values, all
+            columns must be the same length.
+        :param cell_x_padding: The padding for the cells.
+        :param title: The title of the table, can be None if no title is
+            wanted.
+        """
+        values = [[] if column is None else column
+                  for column in columns.values()]
+        if len({len(column) for column in values}) > 1:
+            raise ValueError("'columns' must all be the same length")
+        table = cls(list(columns), [], cell_x_padding, title)
+        table._columns = values
+        table._rows = _ColumnRows(values)
+        return table
+
+    def view(self, page_widths: bool = False) -> "TableView":
+        """Returns a TableView of the whole table, which does not copy any
+            rows.
+
+        :param page_widths: If True the view sizes its columns from its own
+            rows, otherwise from every row of the underlying table.
+        """
+        return TableView([(self, list(range(len(self._headers))),
+                           range(len(self._rows)))],
+                         self._x_padding, self._title, page_widths)
+
+    def project(self, *columns: int | str) -> "TableView":
+        """Returns a TableView of only the given columns, by index or
+        header.
+        """
+        return self.view().project(*columns)
+
+    def slice_rows(self, start: int | None, stop: int | None,
+                   step: int | None = None) -> "TableView":
+        """Returns a TableView of rows[start:stop:step]."""
+        return self.view().slice_rows(start, stop, step)
+
+    def page(self, number: int, size: int) -> "TableView":
+        """Returns a TableView of page 'number' (0 is the first page) when
+        the rows are split into pages of 'size' rows.
+        """
+        return self.view().page(number, size)
+
+    def join(self, other: "TableOut") -> "TableView":
+        """Like 'self + other' but returns a TableView referencing both
+        tables' rows instead of copying them.
+        """
+        return self.view() + other
+
+    def append_row(self, row: list[any, ...]) -> bool:
+        """Adds a row to the bottom of the table.
+
+        :param row: The row to add, it must have a value for every header.
+        :return: True if a column got wider, in which case the next render
+            redraws every row instead of only the new ones.
+        """
+        return self.extend_rows([row])
+
+    def extend_rows(self, rows: Iterable[list[any, ...]]) -> bool:
+        """Adds several rows to the bottom of the table, see append_row.
+        """
+        rows = list(rows)
+        string_rows = list(map(self._checked_strings, rows))
+        self._refresh()
+        # Widths and strings for the existing rows, before they change.
+        widths = self._content_widths_cached()
+        if self._columns is not None:
+            # Columnar tables switch to row storage on their first append.
+            self._strings = [list(row) for row in self._strings]
+            self._columns = None
+        if not self._rows_owned:
+            self._rows = list(self._rows)
+            self._rows_owned = True
+        self._rows.extend(rows)
+        self._strings.extend(string_rows)
+
+        widened = False
+        for column, width in enumerate(self._content_widths(string_rows)):
+            if width > widths[column]:
+                widths[column] = width
+                widened = True
+        return widened
+
+    @classmethod
+    def stream_table(cls, file: TextIO, headers: list[any, ...],
+                     rows: Iterable[list[any, ...]], cell_x_padding: int,
+                     title: str | None,
+                     column_widths: list[int, ...] | None = None,
+                     width_sample: int | None = None,
+                     chunk_rows: int = 4096) -> None:
+        """Writes a table straight to a file-like object without keeping
+            the rendered table (or, given the widths, the rows) in memory.
+
+        :param file: Anything with a write method, e.g. sys.stdout.
+        :param headers: The headers of each column in the table.
+        :param rows: Any iterable of rows, each value is converted to a
+            string exactly once.
+        :param cell_x_padding: The padding for the cells.
+        :param title: The title of the table, can be None if no title is
+            wanted.
+        :param column_widths: The length of the longest value in each column
+            (without padding), if given the rows are only read once.
+        :param width_sample: If 'column_widths' is None only the first
+            'width_sample' rows are used to size the columns, longer values
+            further down will not line up. If both are None every row is
+            held (as strings) until the widths are known.
+        :param chunk_rows: The number of rendered rows per write call.
+        """
+        table = cls(headers, [], cell_x_padding, title)
+        string_rows = map(table._checked_strings, rows)
+        if column_widths is None:
+            sample = list(islice(string_rows, width_sample))
+            column_widths = table._content_widths(sample)
+            string_rows = chain(sample, string_rows)
+        table._write_lines(file, string_rows,
+                           table._padded_widths(column_widths), chunk_rows)
+
+    def _checked_strings(self, row: list[any, ...]) -> list[str, ...]:
+        """Returns the row's values as strings, raising the same error as
+        __init__ if it does not have a value for every header.
+        """
+        strings = [str(value) for value in row]
+        if len(strings) != len(self._headers):
+            raise ValueError("'headers' and 'rows' should have the same "
+                             "number of values")
+        return strings
+
     @staticmethod
     def _column_width_add_dict(column_widths: dict[int: int, ...],
                                column: int, value: int) -> dict[int: int, ...]:
@@ -90,21 +243,113 @@ class TableOut:
             ])
         return table_row
 
+    @staticmethod
+    def _row_template(column_widths: dict[int: int, ...], border: str,
+                      alignment: int | None) -> str:
+        """Returns a str.format template producing the same row as
+        _construct_multi_row, so each row is a single format call.
+        """
+        justify = {0: "<", 2: ">"}.get(alignment, "^")
+        return border + border.join([
+            f"{{:{justify}{width}}}" for width in column_widths.values()
+        ]) + border
+
+    def invalidate(self) -> None:
+        """Drops the cached strings, widths and rendered rows, call it after
+        changing a row of the list given to __init__ in place.
+        """
+        self._strings = None
+        self._widths = None
+        self._head = None
+        self._rendered = list()
+        self._rendered_widths = None
+        self._width_index = dict()
+
+    def _refresh(self) -> None:
+        """Invalidates the caches if rows were added to or removed from the
+        rows list given to __init__ since the last render. Once the table
+        owns its rows (after append_row/extend_rows) or was made from
+        columns only invalidate does.
+        """
+        if (self._rows_owned or self._columns is not None or
+                len(self._rows) == self._rows_seen):
+            return
+        self.invalidate()
+        self._rows_seen = len(self._rows)
+
+    def _string_rows(self) -> list[list[str, ...], ...]:
+        """Returns every row with its values converted to strings, the
+        conversion is only done once (see _refresh and invalidate).
+        """
+        if self._strings is None and self._columns is not None:
+            string_columns = list()
+            self._widths = [len(str(header)) for header in self._headers]
+            for column, values in enumerate(self._columns):
+                strings, width = self._stringify_column(values)
+                string_columns.append(strings)
+                self._widths[column] = max(self._widths[column], width)
+            self._strings = _ColumnRows(string_columns)
+        elif self._strings is None:
+            self._strings = [[str(value) for value in row]
+                             for row in self._rows]
+        return self._strings
+
+    @staticmethod
+    def _stringify_column(values: Sequence) -> tuple[list[str, ...], int]:
+        """Returns a column's values as strings and the longest length."""
+        if hasattr(values, "dtype") and hasattr(values, "astype"):
+            import numpy as np
+            strings = values.astype(str)
+            width = int(np.char.str_len(strings).max()) if len(strings) else 0
+            return strings.tolist(), width
+        strings = list(map(str, values))
+        return strings, max(map(len, strings), default=0)
+
+    def _content_widths(self, string_rows: Iterable[list[str, ...]]
+                        ) -> list[int, ...]:
+        widths = [len(str(header)) for header in self._headers]
+        for column, values in enumerate(zip(*string_rows)):
+            widths[column] = max(widths[column], max(map(len, values)))
+        return widths
+
+    def _padded_widths(self, widths: list[int, ...]) -> dict[int: int, ...]:
+        return {column: width + self._x_padding
+                for column, width in enumerate(widths)}
+
+    def _string_rows_at(self, rows: range) -> Iterator[list[str, ...]]:
+        """Yields the string rows for a range of row indices, only
+        converting those rows if the whole table has not been converted.
+        """
+        if self._strings is not None:
+            return map(self._strings.__getitem__, rows)
+        return ([str(value) for value in self._rows[index]]
+                for index in rows)
+
+    def _range_widths(self, rows: range) -> list[int, ...]:
+        """Returns the content widths of a range of rows. Each range is
+        measured once and kept in the width index.
+        """
+        if rows.step == 1 and len(rows) == len(self._rows):
+            return self._content_widths_cached()
+        key = (rows.start, rows.stop, rows.step)
+        if key not in self._width_index:
+            self._width_index[key] = self._content_widths(
+                self._string_rows_at(rows))
+        return self._width_index[key]
+
+    def _content_widths_cached(self) -> list[int, ...]:
+        if self._widths is None and self._columns is not None:
+            # Measured column by column while converting to strings.
+            self._string_rows()
+        elif self._widths is None:
+            self._widths = self._content_widths(self._string_rows())
+        return self._widths
+
     def _max_column_widths(self):
-        column_widths = dict()
-        for row in self._rows:
-            for column, value in enumerate(row):
-                value_len = len(str(value)) + self._x_padding
-                column_widths = self._column_width_add_dict(column_widths,
-                                                            column, value_len)
-        for column, header in enumerate(self._headers):
-            header_len = len(str(header)) + self._x_padding
-            column_widths = self._column_width_add_dict(column_widths,
-                                                        column, header_len)
-        return column_widths
+        return self._padded_widths(self._content_widths_cached())
 
-    def _make_basic_table(self):
-        column_widths = self._max_column_widths()
+    def _iter_table(self, string_rows: Iterable[list[str, ...]],
+                    column_widths: dict[int: int, ...]) -> Iterator[str]:
         table_frame = self._construct_multi_row(None, column_widths, "+", None)
         table_header = self._construct_multi_row(self._headers, column_widths,
                                                  "|", 0)
@@ -120,14 +365,223 @@ class TableOut:
                      table_header, table_frame]
         else:
             table = [table_frame, table_header, table_frame]
-        for row in self._rows:
-            value_row = self._construct_multi_row(row, column_widths, "|", 1)
-            table.append(value_row)
-        table.append(table_frame)
-        return table
+        yield from table
+        row_template = self._row_template(column_widths, "|", 1)
+        yield from starmap(row_template.format, string_rows)
+        yield table_frame
+
+    def _make_basic_table(self):
+        """Returns the table as a list of lines. The frame, header and
+        rendered rows are cached, so after rows are appended only the new
+        rows are rendered unless a column got wider.
+        """
+        self._refresh()
+        column_widths = self._max_column_widths()
+        if column_widths != self._rendered_widths:
+            self._head = list(self._iter_table((), column_widths))
+            self._rendered = list()
+            self._rendered_widths = column_widths
+        string_rows = self._string_rows()
+        if len(self._rendered) < len(string_rows):
+            row_template = self._row_template(column_widths, "|", 1)
+            self._rendered.extend(starmap(
+                row_template.format,
+                islice(string_rows, len(self._rendered), None)))
+        return self._head[:-1] + self._rendered + self._head[-1:]
+
+    def _write_lines(self, file: TextIO,
+                     string_rows: Iterable[list[str, ...]],
+                     column_widths: dict[int: int, ...],
+                     chunk_rows: int) -> None:
+        lines = self._iter_table(string_rows, column_widths)
+        while chunk := list(islice(lines, chunk_rows)):
+            file.write("\n".join(chunk) + "\n")
+
+    def write_table(self, file: TextIO, chunk_rows: int = 4096) -> None:
+        """Writes the table to a file-like object in chunks of 'chunk_rows'
+        rows instead of joining it into one string.
+        """
+        self._refresh()
+        self._write_lines(file, self._string_rows(),
+                          self._max_column_widths(), chunk_rows)
 
     def print_basic_table(self):
-        print("\n".join(self._make_basic_table()))
+        self.write_table(sys.stdout)
+
+
+class _ColumnRows(Sequence):
+    """Row access to a list of equal length columns, rows are only built
+    when they are indexed or iterated.
+    """
+
+    def __init__(self, columns: list[Sequence, ...]) -> None:
+        self._columns = columns
+
+    def __len__(self) -> int:
+        return len(self._columns[0]) if self._columns else 0
+
+    def __getitem__(self, index: int) -> list[any, ...]:
+        return [column[index] for column in self._columns]
+
+    def __iter__(self) -> Iterator[list[any, ...]]:
+        return map(list, zip(*self._columns))
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+class _ViewRows(Sequence):
+    """The rows of a TableView, each built from the underlying tables when
+    it is indexed.
+    """
+
+    def __init__(self, parts: list[tuple[TableOut, list[int, ...], range],
+                                    ...]) -> None:
+        self._parts = parts
+
+    def __len__(self) -> int:
+        return len(self._parts[0][2])
+
+    def __getitem__(self, index: int) -> list[any, ...]:
+        return [table._rows[rows[index]][column]
+                for table, columns, rows in self._parts
+                for column in columns]
+
+
+class TableView(TableOut):
+    def __init__(self, parts: list[tuple[TableOut, list[int, ...], range],
+                                    ...],
+                 cell_x_padding: int, title: str | None,
+                 page_widths: bool = False):
+        """A read-only window onto one or more TableOut tables, made of
+            (table, column indices, row range) parts placed side by side.
+            Rows are read from the tables when the view is rendered.
+
+        :param parts: The (table, column indices, row range) parts.
+        :param cell_x_padding: The padding for the cells.
+        :param title: The title of the table, can be None if no title is
+            wanted.
+        :param page_widths: If True the columns are sized from the rows in
+            the view, otherwise from every row of the underlying tables.
+        """
+        if len({len(rows) for _, _, rows in parts}) > 1:
+            raise ValueError("Row matrices not of same size")
+        if not any(columns for _, columns, _ in parts):
+            raise ValueError("A view needs at least one column")
+        self._parts = [part for part in parts if part[1]]
+        self._headers = [table._headers[column]
+                         for table, columns, _ in self._parts
+                         for column in columns]
+        self._rows = _ViewRows(self._parts)
+        self._x_padding = cell_x_padding
+        self._title = title
+        self._page_widths = page_widths
+
+    def __add__(self, other: TableOut) -> "TableView":
+        if not isinstance(other, TableView):
+            other = other.view()
+        return TableView(self._parts + other._parts, self._x_padding,
+                         f"{self._title} / {other._title}", self._page_widths)
+
+    def __len__(self):
+        return len(self._rows) * len(self._headers)
+
+    def __repr__(self):
+        return (f"TableView({self._headers}, {len(self._rows)} rows, "
+                f"{self._x_padding}, {self._title})")
+
+    def view(self, page_widths: bool | None = None) -> "TableView":
+        if page_widths is None:
+            page_widths = self._page_widths
+        return TableView(self._parts, self._x_padding, self._title,
+                         page_widths)
+
+    def project(self, *columns: int | str) -> "TableView":
+        located = list()
+        for column in columns:
+            if type(column) != int:
+                if column not in self._headers:
+                    raise ValueError(f"No column with header {column!r}")
+                column = self._headers.index(column)
+            for table, part_columns, rows in self._parts:
+                if column < len(part_columns):
+                    located.append((table, [part_columns[column]], rows))
+                    break
+                column -= len(part_columns)
+            else:
+                raise ValueError(f"Column index out of range, {columns=}")
+        # Merge neighbouring columns that come from the same part.
+        parts = list()
+        for table, part_columns, rows in located:
+            if parts and parts[-1][0] is table and parts[-1][2] == rows:
+                parts[-1][1].extend(part_columns)
+            else:
+                parts.append((table, part_columns, rows))
+        return TableView(parts, self._x_padding, self._title,
+                         self._page_widths)
+
+    def slice_rows(self, start: int | None, stop: int | None,
+                   step: int | None = None) -> "TableView":
+        rows_slice = slice(start, stop, step)
+        return TableView([(table, columns, rows[rows_slice])
+                          for table, columns, rows in self._parts],
+                         self._x_padding, self._title, self._page_widths)
+
+    def page(self, number: int, size: int) -> "TableView":
+        if number < 0 or size < 1:
+            raise ValueError(f"'number' must be at least 0 and 'size' at "
+                             f"least 1, {number=}, {size=}")
+        return self.slice_rows(number * size, (number + 1) * size)
+
+    def append_row(self, row: list[any, ...]) -> bool:
+        raise TypeError("A TableView is read-only, append to its table")
+
+    def extend_rows(self, rows: Iterable[list[any, ...]]) -> bool:
+        raise TypeError("A TableView is read-only, append to its table")
+
+    @classmethod
+    def from_columns(cls, *args, **kwargs) -> "TableView":
+        raise TypeError("A TableView reads TableOut tables, use "
+                        "TableOut.from_columns and view the result")
+
+    @classmethod
+    def stream_table(cls, *args, **kwargs) -> None:
+        raise TypeError("A TableView reads TableOut tables, use "
+                        "TableOut.stream_table")
+
+    def _refresh(self) -> None:
+        for table, _, _ in self._parts:
+            table._refresh()
+
+    def invalidate(self) -> None:
+        for table, _, _ in self._parts:
+            table.invalidate()
+
+    def _string_rows(self) -> Iterator[tuple[str, ...]]:
+        pickers = list()
+        for table, columns, rows in self._parts:
+            if len(columns) == 1:
+                pick = lambda row, column=columns[0]: (row[column],)
+            else:
+                pick = itemgetter(*columns)
+            pickers.append(map(pick, table._string_rows_at(rows)))
+        if len(pickers) == 1:
+            return pickers[0]
+        return (tuple(chain.from_iterable(parts))
+                for parts in zip(*pickers))
+
+    def _content_widths_cached(self) -> list[int, ...]:
+        widths = list()
+        for table, columns, rows in self._parts:
+            table_widths = (table._range_widths(rows) if self._page_widths
+                            else table._content_widths_cached())
+            widths.extend(table_widths[column] for column in columns)
+        return widths
+
+    def _make_basic_table(self):
+        self._refresh()
+        return list(self._iter_table(self._string_rows(),
+                                     self._max_column_widths()))
 
 
 if __name__ == "__main__":
@@ -144,3 +598,22 @@ if __name__ == "__main__":
     print(one)
     print(len(one))
     (one + two).print_basic_table()
+
+    (one.slice_rows(1, None).project("Cost", "Safety") +
+     two.slice_rows(1, None).project(0)).print_basic_table()
+
+    live = TableOut(["Tick", "Value"], [], 2, "Live")
+    for tick in range(1, 6):
+        live.append_row([tick, tick * 111])
+    live.extend_rows([[6, 66666], [7, 7]])
+    live.print_basic_table()
+
+    TableOut.from_columns({"Name": ["one", "two", "three"],
+                           "Length": [3, 3, 5],
+                           "Vowels": [2, 1, 2]}, 2, "Columns"
+                          ).print_basic_table()
+
+    TableOut.stream_table(sys.stdout, ["n", "n ** 2", "n ** 0.5"],
+                          ((n, n ** 2, round(n ** 0.5, 3))
+                           for n in range(1, 11)), 2, "Streamed",
+                          width_sample=5)
@@ -4,43 +4,602 @@ Alexander Bürow - 13 October 2023
 License: GPL3
 """
 
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
-from time import perf_counter_ns
+from functools import wraps
+from time import perf_counter_ns, time_ns
+from typing import Callable, Iterator, NamedTuple
 import os
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, rotation still works but is not guarded across processes.
+    fcntl = None
+
+from console_table import TableOut
+
+
+_HEADER, _STRING, _RECORD, _TEXT, _SESSION = range(5)
+# Records encoded per write when a binary file rotates, a segment can only
+# go over max_bytes by this many records.
+_ROTATE_RECORDS = 256
+
+
+def _format_line(line_start: str, log: str, condition: int, accessory: any,
+                 seperator: str) -> str:
+    if accessory is None:
+        accessory = ""
+    if condition == 0:
+        formatted_log = (f"{line_start}{log: <40}{seperator}"
+                         f"{accessory: <20}")
+    elif condition == 1:
+        formatted_log = (f"{line_start}{log: ^40}{seperator}"
+                         f"{accessory: <20}")
+    else:
+        raise ValueError("'condition' must be 0 or 1.")
+    return formatted_log
+
+
+def _format_prefix(wall_ns: int, seperator: str) -> str:
+    stamp = datetime.fromtimestamp(wall_ns // 1_000_000_000)
+    return f"{stamp.strftime('%d/%m/%y-%H:%M:%S'): <17}{seperator}"
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """Returns the varint at data[pos] and the position after it, raises
+    IndexError if data ends part way through it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class _BinaryEncoder:
+    """Encodes raw records into the '.dbgb' format.
+
+    Every record is a varint length followed by a payload whose first byte
+    is its type:
+        _HEADER: session id, wall clock offset, base timestamp, debug_id
+        _STRING: string id, text (interns a log message)
+        _RECORD: timestamp delta, condition, string id, accessory
+        _TEXT:   timestamp delta, text (blocks such as the span table)
+        _SESSION: session id (switches session when files are shared)
+    Timestamps are zigzag varints relative to the previous record of the
+    session, text fields run to the end of the payload. When 'shared' every
+    encoded batch starts with a header or session record so batches from
+    several processes can be interleaved.
+
+    At most 'max_strings' messages are interned at a time. When the table
+    is full it is cleared and the ids start again from 0, a _STRING record
+    replaces the text of its id, so messages with data in them (f"x={i}")
+    cannot grow the tables of the encoder or the reader without limit.
+    """
+
+    def __init__(self, debug_id: any, wall_offset: int, base: int,
+                 shared: bool = False, max_strings: int = 4096) -> None:
+        self.session_id = int.from_bytes(os.urandom(8), "little")
+        self._shared = shared
+        self._debug_id = str(debug_id).encode()
+        self._wall_offset = wall_offset
+        self._base = base
+        self._max_strings = max_strings
+        self.reset()
+
+    def reset(self) -> None:
+        self._strings = dict()
+        self._last = self._base
+        self._pending_header = True
+
+    @staticmethod
+    def _frame(buffer: bytearray, payload: bytearray) -> None:
+        _write_varint(buffer, len(payload))
+        buffer += payload
+
+    def _write_delta(self, payload: bytearray, timestamp: int) -> None:
+        delta = timestamp - self._last
+        self._last = timestamp
+        _write_varint(payload, delta << 1 if delta >= 0 else
+                      ((-delta) << 1) - 1)
+
+    def _write_header(self, buffer: bytearray) -> None:
+        payload = bytearray([_HEADER])
+        _write_varint(payload, self.session_id)
+        _write_varint(payload, self._wall_offset)
+        _write_varint(payload, self._base)
+        payload += self._debug_id
+        self._frame(buffer, payload)
+        self._pending_header = False
+
+    def _begin(self, buffer: bytearray) -> None:
+        if self._pending_header:
+            self._write_header(buffer)
+        elif self._shared:
+            payload = bytearray([_SESSION])
+            _write_varint(payload, self.session_id)
+            self._frame(buffer, payload)
+
+    def encode(self, records: list[tuple, ...]) -> bytearray:
+        buffer = bytearray()
+        self._begin(buffer)
+        strings = self._strings
+        for timestamp, condition, log, accessory in records:
+            string_id = strings.get(log)
+            if string_id is None:
+                if len(strings) >= self._max_strings:
+                    strings.clear()
+                string_id = strings[log] = len(strings)
+                payload = bytearray([_STRING])
+                _write_varint(payload, string_id)
+                payload += str(log).encode()
+                self._frame(buffer, payload)
+            payload = bytearray([_RECORD])
+            self._write_delta(payload, timestamp)
+            payload.append(condition)
+            _write_varint(payload, string_id)
+            if accessory is not None:
+                payload += str(accessory).encode()
+            self._frame(buffer, payload)
+        return buffer
+
+    def encode_text(self, timestamp: int, text: str) -> bytearray:
+        buffer = bytearray()
+        self._begin(buffer)
+        payload = bytearray([_TEXT])
+        self._write_delta(payload, timestamp)
+        payload += text.encode()
+        self._frame(buffer, payload)
+        return buffer
+
+
+class _AppendFile:
+    """A log file written with one os.write per call on an O_APPEND
+    descriptor, so whole batches from several processes never interleave.
+
+    When it grows past 'max_bytes' or is older than 'max_age' seconds it is
+    renamed to '{path}.1' (older segments shift up to '{path}.{backup_count}'
+    and the oldest is removed). With 'split_lines' a write is split at the
+    last line that fits in 'max_bytes', otherwise the size is only checked
+    after each write. A process only sees that another one rotated after
+    its own write, so a shared segment can also get one write per process
+    past 'max_bytes'. Rotation, clearing and deleting hold an
+    flock on '{path}.lock', and a writer whose file was rotated or replaced
+    by another process reopens the path and calls 'on_reopen'.
+    """
+
+    def __init__(self, path: str, max_bytes: int | None,
+                 max_age: float | None, backup_count: int,
+                 on_reopen: Callable | None = None,
+                 split_lines: bool = False) -> None:
+        self._path = path
+        self._lock_path = f"{path}.lock"
+        self._max_bytes = max_bytes
+        self._max_age = None if max_age is None else int(max_age * 10 ** 9)
+        self._backup_count = backup_count
+        self._on_reopen = on_reopen
+        self._split_lines = split_lines
+        self.closed = False
+        self._open()
+
+    def _open(self) -> None:
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND |
+                           os.O_CREAT, 0o644)
+        self._opened = perf_counter_ns()
+
+    def _reopen(self) -> None:
+        os.close(self._fd)
+        self._open()
+        if self._on_reopen is not None:
+            self._on_reopen()
+
+    def _is_current(self) -> bool:
+        try:
+            current = os.stat(self._path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self._fd)
+        return (current.st_ino, current.st_dev) == (opened.st_ino,
+                                                    opened.st_dev)
+
+    @contextmanager
+    def _lock(self):
+        with open(self._lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def write(self, data: str | bytes) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        start = 0
+        while start < len(data):
+            stop = self._piece_end(data, start)
+            view = memoryview(data)[start:stop]
+            while view:
+                view = view[os.write(self._fd, view):]
+            start = stop
+            self._check_rotation()
+        return len(data)
+
+    def _piece_end(self, data: bytes, start: int) -> int:
+        """Returns where the next os.write of data should stop, after the
+        last whole line that still fits in the file when splitting lines.
+        """
+        if self._max_bytes is None or not self._split_lines:
+            return len(data)
+        space = self._max_bytes - os.fstat(self._fd).st_size
+        if len(data) - start <= space:
+            return len(data)
+        stop = data.rfind(b"\n", start, start + max(space, 0)) + 1
+        if stop <= start and space < self._max_bytes:
+            # The next line does not fit, it starts a new segment.
+            self.rotate()
+            return self._piece_end(data, start)
+        if stop <= start:
+            # A line longer than max_bytes gets a segment of its own.
+            stop = data.find(b"\n", start) + 1 or len(data)
+        return stop
+
+    def _check_rotation(self) -> None:
+        if not self._is_current():
+            with self._lock():
+                self._reopen()
+        elif ((self._max_bytes is not None and
+               os.fstat(self._fd).st_size >= self._max_bytes) or
+              (self._max_age is not None and
+               perf_counter_ns() - self._opened >= self._max_age)):
+            self.rotate()
+
+    def rotate(self) -> None:
+        with self._lock():
+            # Another process may have rotated since the size was checked.
+            if self._is_current():
+                for index in range(self._backup_count - 1, 0, -1):
+                    if os.path.exists(segment := f"{self._path}.{index}"):
+                        os.replace(segment, f"{self._path}.{index + 1}")
+                if self._backup_count:
+                    os.replace(self._path, f"{self._path}.1")
+                else:
+                    os.remove(self._path)
+            self._reopen()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self._fd)
+            self.closed = True
+
+    def clear(self) -> None:
+        """Replaces the file with an empty one, writers in other processes
+        see the new inode and reopen it.
+        """
+        with self._lock():
+            empty_path = f"{self._path}.{os.getpid()}.tmp"
+            os.close(os.open(empty_path, os.O_WRONLY | os.O_CREAT |
+                             os.O_TRUNC, 0o644))
+            os.replace(empty_path, self._path)
+
+    def delete(self) -> None:
+        """Removes the file and every rotated segment. The lock file is
+        kept as other processes may still be holding it.
+        """
+        with self._lock():
+            for index in range(self._backup_count, 0, -1):
+                if os.path.exists(segment := f"{self._path}.{index}"):
+                    os.remove(segment)
+            if os.path.exists(self._path):
+                os.remove(self._path)
+
+
+class DbgRecord(NamedTuple):
+    """A record read back from a '.dbgb' file. 'timestamp' is wall clock
+    ns, 'condition' is None for text blocks such as the span table.
+    """
+    debug_id: str
+    timestamp: int
+    condition: int | None
+    log: str
+    accessory: str
+
+
+class DbgReader:
+    def __init__(self, filename: str, debug_id: any = None,
+                 start: datetime | int | None = None,
+                 end: datetime | int | None = None,
+                 chunk_size: int = 1 << 20, segments: int = 0) -> None:
+        """Streams the records of '{filename}.dbgb' written by a binary
+            DbgLog.
+
+        :param debug_id: Only yield records from logs with this debug_id.
+        :param start: Only yield records at or after this time (a datetime
+            or wall clock ns).
+        :param end: Only yield records before this time (a datetime or wall
+            clock ns).
+        :param chunk_size: The number of bytes read from the file at a time.
+        :param segments: The number of rotated segments ('{filename}.dbgb.N')
+            to read, oldest first, before the current file.
+        """
+        self._path = f"{filename}.dbgb"
+        self._paths = [f"{self._path}.{index}"
+                       for index in range(segments, 0, -1)
+                       if os.path.exists(f"{self._path}.{index}")]
+        self._paths.append(self._path)
+        self._debug_id = None if debug_id is None else str(debug_id)
+        self._start = self._to_ns(start)
+        self._end = self._to_ns(end)
+        self._chunk_size = chunk_size
+        self._seperator = "  ::  "
+
+    @staticmethod
+    def _to_ns(moment: datetime | int | None) -> int | None:
+        if isinstance(moment, datetime):
+            return round(moment.timestamp() * 10 ** 9)
+        return moment
+
+    def _payloads(self, path: str) -> Iterator[bytes]:
+        with open(path, "rb") as file:
+            data = b""
+            pos = 0
+            while chunk := file.read(self._chunk_size):
+                data = data[pos:] + chunk
+                pos = 0
+                while True:
+                    try:
+                        length, start = _read_varint(data, pos)
+                    except IndexError:
+                        break
+                    if start + length > len(data):
+                        break
+                    pos = start + length
+                    yield data[start:pos]
+
+    def __iter__(self) -> Iterator[DbgRecord]:
+        for path in self._paths:
+            yield from self._read(path)
+
+    def _read(self, path: str) -> Iterator[DbgRecord]:
+        sessions = dict()
+        session = None
+        for payload in self._payloads(path):
+            kind = payload[0]
+            if kind == _HEADER:
+                session_id, pos = _read_varint(payload, 1)
+                wall_offset, pos = _read_varint(payload, pos)
+                base, pos = _read_varint(payload, pos)
+                session = sessions[session_id] = {
+                    "debug_id": payload[pos:].decode(),
+                    "wall_offset": wall_offset, "last": base,
+                    "strings": dict(),
+                }
+                continue
+            if kind == _SESSION:
+                session_id, _ = _read_varint(payload, 1)
+                if session_id not in sessions:
+                    raise ValueError(f"{path} switches to session "
+                                     f"{session_id} before its header")
+                session = sessions[session_id]
+                continue
+            if session is None:
+                raise ValueError(f"{path} does not start with a session "
+                                 f"header")
+            if kind == _STRING:
+                string_id, pos = _read_varint(payload, 1)
+                session["strings"][string_id] = payload[pos:].decode()
+                continue
+            delta, pos = _read_varint(payload, 1)
+            session["last"] += -((delta + 1) >> 1) if delta & 1 else \
+                delta >> 1
+            timestamp = session["wall_offset"] + session["last"]
+            if ((self._debug_id is not None and
+                 session["debug_id"] != self._debug_id) or
+                    (self._start is not None and timestamp < self._start) or
+                    (self._end is not None and timestamp >= self._end)):
+                continue
+            if kind == _RECORD:
+                condition = payload[pos]
+                string_id, pos = _read_varint(payload, pos + 1)
+                yield DbgRecord(session["debug_id"], timestamp, condition,
+                                session["strings"][string_id],
+                                payload[pos:].decode())
+            elif kind == _TEXT:
+                yield DbgRecord(session["debug_id"], timestamp, None,
+                                payload[pos:].decode(), "")
+            else:
+                raise ValueError(f"Unknown record type {kind} in {path}")
+
+    def iter_text(self) -> Iterator[str]:
+        """Yields the records as lines in the '.dbg' text format."""
+        prefix_second = None
+        line_start = ""
+        for record in self:
+            if record.condition is None:
+                yield record.log.rstrip("\n")
+                continue
+            if record.timestamp // 1_000_000_000 != prefix_second:
+                prefix_second = record.timestamp // 1_000_000_000
+                line_start = _format_prefix(record.timestamp, self._seperator)
+            yield _format_line(line_start, record.log, record.condition,
+                               record.accessory, self._seperator)
+
+    def to_text(self, filename: str) -> None:
+        """Writes the records to '{filename}.dbg' in the text format."""
+        with open(f"{filename}.dbg", "a") as text_file:
+            for line in self.iter_text():
+                text_file.write(f"{line}\n")
+
+
+class _SpanStats:
+    """Call count, total/min/max and a log-linear latency histogram for one
+    span name. Each power of two is split into 2 ** _SUB_BITS buckets so
+    percentiles are within ~12% of the true value.
+    """
+    _SUB_BITS = 3
+    __slots__ = ("count", "total", "minimum", "maximum", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = 0
+        self.buckets = dict()
+
+    def add(self, elapsed: int) -> None:
+        self.count += 1
+        self.total += elapsed
+        if self.minimum is None or elapsed < self.minimum:
+            self.minimum = elapsed
+        if elapsed > self.maximum:
+            self.maximum = elapsed
+        if elapsed < 2 << self._SUB_BITS:
+            bucket = elapsed
+        else:
+            shift = elapsed.bit_length() - self._SUB_BITS - 1
+            bucket = (shift << self._SUB_BITS) + (elapsed >> shift)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction: float) -> int:
+        """Returns the midpoint of the bucket holding the given fraction of
+        calls, clamped to the observed min and max.
+        """
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                break
+        if bucket < 2 << self._SUB_BITS:
+            value = bucket
+        else:
+            shift = (bucket >> self._SUB_BITS) - 1
+            mantissa = bucket - (shift << self._SUB_BITS)
+            value = (mantissa << shift) + (1 << shift) // 2
+        return min(max(value, self.minimum), self.maximum)
+
+
+class _Span:
+    __slots__ = ("_stats", "_start")
+
+    def __init__(self, stats: _SpanStats) -> None:
+        self._stats = stats
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stats.add(perf_counter_ns() - self._start)
 
 
 class DbgLog:
     def __init__(self, filename: str, debug_id, console_log: bool,
-                 file_log: bool) -> None:
+                 file_log: bool, background: bool = False,
+                 queue_size: int = 65536, flush_interval: float = 0.5,
+                 queue_policy: str = "block",
+                 file_format: str = "text", shared: bool = False,
+                 max_bytes: int | None = None, max_age: float | None = None,
+                 backup_count: int = 5) -> None:
+        """Creates a debug log which writes to '{filename}.dbg' and/or the
+            console.
+
+        :param background: If True records are put on a bounded queue and
+            formatted/written in batches by a writer thread instead of on
+            every call.
+        :param queue_size: The maximum number of records waiting on the
+            queue (background only).
+        :param flush_interval: The maximum number of seconds a record waits
+            on the queue before being written (background only).
+        :param queue_policy: What to do when the queue is full, "block" waits
+            for the writer, "drop" discards the record and counts it.
+        :param file_format: "text" writes '{filename}.dbg', "binary" writes
+            the compact '{filename}.dbgb' format read by DbgReader.
+        :param shared: If True the file may be written by several processes
+            at once, each batch of records is appended with a single
+            O_APPEND write (use with background=True to batch writes), or
+            a few when the file rotates.
+        :param max_bytes: Rotate the file once it reaches this size. Text
+            files are split between lines, so only a line longer than
+            max_bytes makes a larger segment. Binary files are written 256
+            records at a time and a segment can be larger by up to that.
+        :param max_age: Rotate the file once it is this many seconds old.
+        :param backup_count: The number of rotated segments to keep.
+        """
         self._filename = filename
         self._file_log = file_log
         self._console_log = console_log
         self._debug_id = debug_id
+        self._background = background
+        self._queue_size = queue_size
+        self._flush_interval = flush_interval
+        self._queue_policy = queue_policy
+        self._file_format = file_format
+        self._shared = shared
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._backup_count = backup_count
 
         self._check_valid()
         self._start_dbg = perf_counter_ns()
+        # Records carry monotonic ns, the wall clock is derived from them.
+        self._wall_offset = time_ns() - self._start_dbg
+        self._prefix_second = None
+        self._prefix = ""
         self._seperator = "  ::  "
-        format_log = self._make_line("=== START OF LOG ===", 1, self._debug_id)
-        if self._file_log:
-            self._log_file = open(f"{self._filename}.dbg", "a")
-            self._log_file.write(f"{format_log}\n")
-        if self._console_log:
-            print(format_log)
-
-    def _make_line(self, log: str, condition: int, accessory: any) -> str:
-        line_start = (
-            f"{datetime.now().strftime('%d/%m/%y-%H:%M:%S'): <17}"
-            f"{self._seperator}"
-        )
-        if condition == 0:
-            formatted_log = (f"{line_start}{log: <40}{self._seperator}"
-                             f"{accessory: <20}")
-        elif condition == 1:
-            formatted_log = (f"{line_start}{log: ^40}{self._seperator}"
-                             f"{accessory: <20}")
+        self._spans = dict()
+        self._encoder = None
+        self._writer_error = None
+        if self._file_format == "binary":
+            self._path = f"{self._filename}.dbgb"
+            self._encoder = _BinaryEncoder(self._debug_id, self._wall_offset,
+                                           self._start_dbg, self._shared)
         else:
-            raise ValueError("'condition' must be 0 or 1.")
-        return formatted_log
+            self._path = f"{self._filename}.dbg"
+        if self._file_log and (self._shared or self._max_bytes is not None or
+                               self._max_age is not None):
+            self._log_file = _AppendFile(
+                self._path, self._max_bytes, self._max_age,
+                self._backup_count,
+                self._encoder.reset if self._encoder else None,
+                self._encoder is None)
+        elif self._file_log:
+            self._log_file = open(self._path,
+                                  "ab" if self._encoder else "a",
+                                  buffering=1 << 16 if background else -1)
+        if self._background:
+            self._start_writer()
+        self._emit("=== START OF LOG ===", 1, self._debug_id)
+
+    def _line_start(self, timestamp: int) -> str:
+        """Returns the wall clock prefix for a monotonic timestamp, only
+        re-running strftime when the second changes.
+        """
+        wall_ns = self._wall_offset + timestamp
+        if wall_ns // 1_000_000_000 != self._prefix_second:
+            self._prefix = _format_prefix(wall_ns, self._seperator)
+            self._prefix_second = wall_ns // 1_000_000_000
+        return self._prefix
+
+    def _make_line(self, log: str, condition: int, accessory: any,
+                   timestamp: int) -> str:
+        return _format_line(self._line_start(timestamp), log, condition,
+                            accessory, self._seperator)
 
     def _check_valid(self):
         for char in self._filename:
@@ -50,6 +609,147 @@ class DbgLog:
         if self._file_log not in [0, 1] or self._console_log not in [0, 1]:
             raise ValueError("'console_log' and 'file_log' must be either "
                              "True or false")
+        if self._file_format not in ["text", "binary"]:
+            raise ValueError(f"'file_format' must be 'text' or 'binary', "
+                             f"{self._file_format=}")
+        if self._queue_policy not in ["block", "drop"]:
+            raise ValueError(f"'queue_policy' must be 'block' or 'drop', "
+                             f"{self._queue_policy=}")
+        if ((self._max_bytes is not None and self._max_bytes < 1) or
+                (self._max_age is not None and self._max_age <= 0) or
+                self._backup_count < 0):
+            raise ValueError(f"'max_bytes' and 'max_age' must be positive "
+                             f"and 'backup_count' at least 0, "
+                             f"{self._max_bytes=}, {self._max_age=}, "
+                             f"{self._backup_count=}")
+        if self._queue_size < 1 or self._flush_interval <= 0:
+            raise ValueError(f"'queue_size' and 'flush_interval' must be "
+                             f"positive, {self._queue_size=}, "
+                             f"{self._flush_interval=}")
+
+    def _start_writer(self) -> None:
+        self._queue = deque()
+        self._batch_size = max(1, self._queue_size // 2)
+        self._dropped = 0
+        self._closing = False
+        self._wake = threading.Event()
+        self._space = threading.Condition()
+        self._writer = threading.Thread(target=self._writer_loop,
+                                        name=f"DbgLog-{self._filename}",
+                                        daemon=True)
+        self._writer.start()
+
+    def _stop_writer(self) -> None:
+        self._closing = True
+        self._wake.set()
+        self._writer.join()
+        self._background = False
+        if self._file_log:
+            self._log_file.flush()
+
+    def _writer_loop(self) -> None:
+        while not self._closing:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            self._drain()
+        self._drain()
+
+    def _drain(self) -> None:
+        """Formats and writes every record currently on the queue as one
+        batch, then wakes any callers blocked on a full queue. An error is
+        kept for dbg_close instead of stopping the writer thread.
+        """
+        popleft = self._queue.popleft
+        records = [popleft() for _ in range(len(self._queue))]
+        try:
+            if records:
+                self._write_batch(records)
+                if self._file_log:
+                    self._log_file.flush()
+        except Exception as error:
+            if self._writer_error is None:
+                self._writer_error = error
+        finally:
+            with self._space:
+                self._space.notify_all()
+
+    def _write_batch(self, records: list[tuple, ...]) -> None:
+        """Writes a batch on the writer thread, if a record cannot be
+        formatted the batch is formatted with every accessory as a str.
+        Nothing is written until the whole batch is formatted, so no sink
+        gets a record twice.
+        """
+        try:
+            text = self._format_records(records)
+        except (TypeError, ValueError):
+            records = [(timestamp, condition, log,
+                        None if accessory is None else str(accessory))
+                       for timestamp, condition, log, accessory in records]
+            text = self._format_records(records)
+        self._write_formatted(records, text)
+
+    def _enqueue_full(self, record: tuple) -> None:
+        """Applies the queue policy to a record arriving at a full queue."""
+        if self._queue_policy == "drop":
+            self._dropped += 1
+            return
+        queue = self._queue
+        self._wake.set()
+        with self._space:
+            while len(queue) >= self._queue_size and self._writer.is_alive():
+                self._space.wait(self._flush_interval)
+        if self._writer.is_alive():
+            queue.append(record)
+        else:
+            self._dropped += 1
+
+    def _write_records(self, records: list[tuple, ...]) -> None:
+        """Formats raw (timestamp, condition, log, accessory) records and
+        writes them to every enabled sink.
+        """
+        self._write_formatted(records, self._format_records(records))
+
+    def _format_records(self, records: list[tuple, ...]) -> str | None:
+        """Returns the records as text lines, or None if no sink is text."""
+        if not (self._console_log or
+                (self._file_log and self._encoder is None)):
+            return None
+        make_line = self._make_line
+        return "".join([
+            f"{make_line(log, condition, accessory, timestamp)}\n"
+            for timestamp, condition, log, accessory in records
+        ])
+
+    def _write_formatted(self, records: list[tuple, ...],
+                         text: str | None) -> None:
+        if self._file_log and self._encoder is not None:
+            step = len(records)
+            if self._max_bytes is not None or self._max_age is not None:
+                step = _ROTATE_RECORDS
+            for first in range(0, len(records), step):
+                self._log_file.write(
+                    self._encoder.encode(records[first:first + step]))
+        elif self._file_log:
+            self._log_file.write(text)
+        if self._console_log:
+            sys.stdout.write(text)
+
+    def _write_text(self, text: str) -> None:
+        if self._file_log:
+            self._log_file.write(
+                text if self._encoder is None else
+                self._encoder.encode_text(perf_counter_ns(), text))
+        if self._console_log:
+            sys.stdout.write(text)
+
+    def _emit(self, log: str, condition: int, accessory: any) -> None:
+        record = (perf_counter_ns(), condition, log, accessory)
+        if self._background:
+            # Control lines bypass the queue policy so they are never dropped.
+            self._queue.append(record)
+            self._wake.set()
+        elif self._file_log or self._console_log:
+            self._write_records([record])
 
     @staticmethod
     def _format_time(time_ns: int):
@@ -73,32 +773,106 @@ class DbgLog:
         return formatted_time
 
     def dbg_print(self, log: str, accessory: any = None):
-        if accessory is None:
-            accessory = ""
-        format_log = self._make_line(log, 0, accessory)
+        if self._background:
+            queue = self._queue
+            if len(queue) < self._queue_size:
+                queue.append((perf_counter_ns(), 0, log, accessory))
+                if len(queue) == self._batch_size:
+                    self._wake.set()
+            else:
+                self._enqueue_full((perf_counter_ns(), 0, log, accessory))
+            return
+        if self._encoder is not None:
+            self._write_records([(perf_counter_ns(), 0, log, accessory)])
+            return
+        if not (self._file_log or self._console_log):
+            return
+        format_log = self._make_line(log, 0, accessory, perf_counter_ns())
         if self._file_log:
             self._log_file.write(f"{format_log}\n")
         if self._console_log:
             print(format_log)
 
+    def _span_stats(self, name: str) -> _SpanStats:
+        stats = self._spans.get(name)
+        if stats is None:
+            stats = self._spans[name] = _SpanStats()
+        return stats
+
+    def span(self, name: str) -> _Span:
+        """Returns a context manager which times its block under 'name'.
+
+        :param name: The name the timings are grouped under.
+        """
+        return _Span(self._span_stats(name))
+
+    def timed(self, name: str | None = None) -> Callable:
+        """Returns a decorator which times every call of the decorated
+        function under 'name' (the function's qualified name by default).
+        """
+        def decorator(func: Callable) -> Callable:
+            stats = self._span_stats(name or func.__qualname__)
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    stats.add(perf_counter_ns() - start)
+            return wrapper
+        return decorator
+
+    def span_table(self) -> TableOut:
+        """Returns a TableOut summarising every span recorded so far."""
+        rows = list()
+        for name, stats in self._spans.items():
+            if not stats.count:
+                continue
+            rows.append([
+                name, stats.count, self._format_time(stats.total),
+                self._format_time(stats.minimum),
+                self._format_time(stats.maximum),
+                self._format_time(stats.total // stats.count),
+                self._format_time(stats.percentile(0.5)),
+                self._format_time(stats.percentile(0.99)),
+            ])
+        return TableOut(["Span", "Calls", "Total", "Min", "Max", "Mean",
+                         "p50", "p99"], rows, 2, f"{self._debug_id} spans")
+
     def dbg_close(self):
         end_dbg = self._format_time(perf_counter_ns() - self._start_dbg)
-        format_log = self._make_line("=== END OF LOG ===", 1, end_dbg)
+        if self._background:
+            if self._dropped:
+                self._emit("=== DROPPED RECORDS ===", 1, self._dropped)
+            self._stop_writer()
+        if any(stats.count for stats in self._spans.values()):
+            self._write_text(f"{self.span_table()}\n")
+        if self._writer_error is not None:
+            self._emit("=== WRITER ERROR ===", 1, repr(self._writer_error))
+        self._emit("=== END OF LOG ===", 1, end_dbg)
         if self._file_log:
-            self._log_file.write(f"{format_log}\n")
-        if self._console_log:
-            print(format_log)
+            self._log_file.flush()
+        if self._writer_error is not None:
+            raise RuntimeError("the background writer could not write every "
+                               "record") from self._writer_error
 
     def dbg_delete(self):
         if not self._log_file.closed:
             self._log_file.close()
-        os.remove(f"{self._filename}.dbg")
+        if isinstance(self._log_file, _AppendFile):
+            self._log_file.delete()
+        else:
+            os.remove(self._path)
 
     def dbg_clear(self):
         if not self._log_file.closed:
             self._log_file.close()
-        clear_file = open(f"{self._filename}.dbg", "w")
-        clear_file.close()
+        if isinstance(self._log_file, _AppendFile):
+            self._log_file.clear()
+        else:
+            clear_file = open(self._path, "w")
+            clear_file.close()
 
 
 if __name__ == "__main__":
@@ -107,3 +881,30 @@ if __name__ == "__main__":
         log.dbg_print("Hello World", f"Test {i + 1}")
     log.dbg_close()
     log.dbg_delete()
+
+    log = DbgLog("test", 84, True, True, background=True,
+                 flush_interval=0.1)
+    for i in range(10):
+        log.dbg_print("Hello World", f"Test {i + 1}")
+    log.dbg_close()
+    log.dbg_delete()
+
+    log = DbgLog("test", 85, True, False)
+
+    @log.timed()
+    def triangle(number: int) -> int:
+        return sum(range(number + 1))
+
+    for i in range(1000):
+        triangle(i)
+        with log.span("sorted"):
+            sorted(range(i, 0, -1))
+    log.dbg_close()
+
+    log = DbgLog("test", 86, False, True, file_format="binary")
+    for i in range(10):
+        log.dbg_print("Hello World", f"Test {i + 1}")
+    log.dbg_close()
+    for line in DbgReader("test", debug_id=86).iter_text():
+        print(line)
+    log.dbg_delete()
@@ -7,6 +7,17 @@ License: GPL3
 
 from __future__ import annotations
 
+import os
+from array import array
+from collections import deque
+from collections.abc import Mapping
+from itertools import chain, starmap
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from typing import Iterable, Iterator, MutableSequence, Sequence
+
+_MISSING = object()
+
 
 class DictUtils:
     def __init__(self, dictionary: dict):
@@ -59,13 +70,11 @@ class DictUtils:
                     if key in self._dict:
                         current_val = self._dict[key]
                         if type(current_val) != list:
-                            if (hasattr(current_val, "__len__") and
-                                    type(current_val) != str):
-                                self._dict[key] = list(current_val)
-                            else:
-                                self._dict[key] = [current_val, value]
-                        else:
-                            self._dict[key].append(value)
+                            current_val = self._as_list(current_val)
+                            self._dict[key] = current_val
+                        current_val.append(value)
+                    else:
+                        self._dict[key] = [value]
             case _:
                 raise ValueError(f"Not a valid condition, {condition=}, "
                                  f"{type(condition)=}")
@@ -87,6 +96,487 @@ class DictUtils:
         """
         self.add_key_value_list([(key, value)], condition)
 
+    @staticmethod
+    def _as_list(value: any) -> list:
+        """Converts a value for condition 4, directly if it has a length
+        (and is not a str) otherwise as the 0th value of a list.
+        """
+        if hasattr(value, "__len__") and type(value) != str:
+            return list(value)
+        return [value]
+
+    def merge(self, key_val: Mapping | Iterable[tuple[any, any]],
+              condition: int, raise_on_conflict: bool = False) -> list:
+        """Merges many key/value pairs into the dictionary at once, with the
+        same conditions as add_key_value_list.
+
+        Instead of stopping at the first key that does not fit the condition
+        (a key that already exists for condition 0, a value that is not a
+        list for condition 3) all of them are collected and returned, the
+        other pairs are still merged. If raise_on_conflict is True a
+        ValueError listing the keys is raised and the dictionary is not
+        changed.
+
+        :param key_val: A mapping or an iterable of key/value pairs.
+        :param condition: See add_key_value_list.
+        :param raise_on_conflict: Raise instead of returning the conflicts.
+        :return: The keys which were not merged.
+        """
+        if raise_on_conflict:
+            if not isinstance(key_val, Mapping):
+                key_val = list(key_val)
+            conflicts = self.find_conflicts(key_val, condition)
+            if conflicts:
+                self._raise_conflicts(conflicts, condition)
+        if isinstance(key_val, Mapping):
+            pairs = key_val.items()
+        else:
+            pairs = key_val
+        match condition:
+            case 0:
+                conflicts = self._merge_new(key_val)
+            case 1:
+                self._dict.update(key_val)
+                conflicts = []
+            case 2:
+                deque(starmap(self._dict.setdefault, pairs), maxlen=0)
+                conflicts = []
+            case 3 | 4:
+                conflicts = self._merge_lists(pairs, condition)
+            case _:
+                raise ValueError(f"Not a valid condition, {condition=}, "
+                                 f"{type(condition)=}")
+        return conflicts
+
+    def find_conflicts(self, key_val: Mapping | Iterable[tuple[any, any]],
+                       condition: int) -> list:
+        """Returns the keys that merge would not merge for the condition,
+        without changing the dictionary.
+        """
+        if isinstance(key_val, Mapping):
+            key_val = key_val.items()
+        match condition:
+            case 0:
+                seen = set()
+                conflicts = [key for key, _ in key_val if key in self._dict
+                             or key in seen or seen.add(key)]
+            case 3:
+                conflicts = [key for key, _ in key_val
+                             if type(self._dict.get(key, [])) != list]
+            case 1 | 2 | 4:
+                conflicts = []
+            case _:
+                raise ValueError(f"Not a valid condition, {condition=}, "
+                                 f"{type(condition)=}")
+        return list(dict.fromkeys(conflicts))
+
+    @staticmethod
+    def _raise_conflicts(conflicts: list, condition: int) -> None:
+        raise ValueError(f"{len(conflicts)} keys do not work for "
+                         f"{condition=}, conflicts={conflicts[:10]}"
+                         f"{'...' if len(conflicts) > 10 else ''}")
+
+    def _merge_new(self,
+                   key_val: Mapping | Iterable[tuple[any, any]]) -> list:
+        """Condition 0, adds the pairs whose keys are not in the dictionary
+        (or earlier in key_val) and returns the other keys.
+        """
+        dictionary = self._dict
+        if (isinstance(key_val, Mapping) and
+                dictionary.keys().isdisjoint(key_val)):
+            dictionary.update(key_val)
+            return []
+        pairs = key_val.items() if isinstance(key_val, Mapping) else key_val
+        conflicts = dict()
+        for key, value in pairs:
+            if key in dictionary:
+                conflicts[key] = None
+            else:
+                dictionary[key] = value
+        return list(conflicts)
+
+    def _merge_lists(self, pairs: Iterable[tuple[any, any]],
+                     condition: int) -> list:
+        """Conditions 3 and 4 in a single pass, returns the keys whose value
+        is not a list for condition 3.
+        """
+        dictionary = self._dict
+        get = dictionary.get
+        conflicts = dict()
+        for key, value in pairs:
+            current_val = get(key, _MISSING)
+            if current_val is _MISSING:
+                dictionary[key] = [value]
+            elif type(current_val) == list:
+                current_val.append(value)
+            elif condition == 4:
+                current_val = self._as_list(current_val)
+                current_val.append(value)
+                dictionary[key] = current_val
+            else:
+                conflicts[key] = None
+        return list(conflicts)
+
+
+class MultiMap(Mapping):
+    """A mapping of key -> every value added for that key, in the order they
+    were added. This is what conditions 3 and 4 of DictUtils build, without
+    checking or converting the stored values on each append.
+
+    If typecode is given (see the array module, for example "q" or "d") the
+    values of each key are stored in an array.array instead of a list.
+    """
+    def __init__(self, typecode: str | None = None) -> None:
+        self._typecode = typecode
+        self._groups = dict()
+
+    @classmethod
+    def group_by(cls, keys: Iterable, values: Iterable,
+                 typecode: str | None = None) -> MultiMap:
+        """Returns a MultiMap grouping values by the key at the same index,
+        for example two columns from FileParser.csv_reader. The values must
+        already be numbers if a typecode is given.
+        """
+        multi_map = cls(typecode)
+        multi_map.add_many(zip(keys, values))
+        return multi_map
+
+    def __repr__(self):
+        return f"MultiMap({self._groups})"
+
+    def __getitem__(self, key: any) -> MutableSequence:
+        return self._groups[key]
+
+    def __iter__(self) -> Iterator:
+        return iter(self._groups)
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def __contains__(self, key: any) -> bool:
+        return key in self._groups
+
+    def _new_group(self, values: Iterable = ()) -> MutableSequence:
+        if self._typecode is None:
+            return list(values)
+        return array(self._typecode, values)
+
+    def add(self, key: any, value: any) -> None:
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = self._new_group()
+        group.append(value)
+
+    def add_many(self, key_val: Iterable[tuple[any, any]]) -> None:
+        """Adds every key/value pair from an iterable, which is read once.
+        With a typecode the values are grouped in lists first and each key
+        is then extended once, which is faster than appending to arrays.
+        """
+        groups = self._groups if self._typecode is None else dict()
+        get = groups.get
+        for key, value in key_val:
+            group = get(key)
+            if group is None:
+                group = groups[key] = []
+            group.append(value)
+        if groups is not self._groups:
+            self.merge(groups)
+
+    def merge(self, other: Mapping[any, Iterable]) -> None:
+        """Adds the values of every key in other (a MultiMap or a mapping of
+        key -> values) after the values already there.
+        """
+        groups = self._groups
+        for key, values in other.items():
+            group = groups.get(key)
+            if group is None:
+                groups[key] = self._new_group(values)
+            else:
+                group.extend(values)
+
+    def value_count(self) -> int:
+        """Returns the number of values over all the keys."""
+        return sum(map(len, self._groups.values()))
+
+    def to_dict(self) -> dict[any, list]:
+        """Returns a dict of key -> list of values."""
+        return {key: list(group) for key, group in self._groups.items()}
+
+
+def _shard_worker(connection: Connection) -> None:
+    """Runs in a worker process and owns one shard of a ShardedDict, it
+    answers the (command, *arguments) messages sent through connection.
+    Batches arrive as (keys, values) columns, which pickle much faster than
+    lists of pairs.
+    """
+    shard = DictUtils(dict())
+    staged = None
+    while True:
+        command, *arguments = connection.recv()
+        match command:
+            case "merge" | "stage":
+                keys, values, condition = arguments
+                if hasattr(keys, "tolist"):
+                    keys = keys.tolist()
+                if hasattr(values, "tolist"):
+                    values = values.tolist()
+                if command == "merge":
+                    connection.send(shard.merge(zip(keys, values),
+                                                condition))
+                else:
+                    pairs = list(zip(keys, values))
+                    staged = (pairs, condition)
+                    connection.send(shard.find_conflicts(pairs, condition))
+            case "commit":
+                connection.send(shard.merge(*staged))
+                staged = None
+            case "discard":
+                staged = None
+                connection.send(None)
+            case "get":
+                key, = arguments
+                found = key in shard._dict
+                connection.send((found, shard._dict[key] if found else None))
+            case "len":
+                connection.send(len(shard._dict))
+            case "keys":
+                connection.send(list(shard._dict))
+            case "dict":
+                connection.send(shard._dict)
+            case "close":
+                connection.close()
+                return
+
+
+class ShardedDict(Mapping):
+    """A dictionary split by the hash of the keys into shard_count shards.
+    Each shard lives in its own worker process, so a merge only sends every
+    shard its part of the pairs and the shards merge them at the same time,
+    with the same conditions as DictUtils.
+
+    The parent splits the pairs by shard and sends them, which is serial.
+    merge on a list of pairs costs about as much in the parent as a single
+    process merge with conditions 0-2, so those only scale with cores
+    through merge_columns on NumPy integer keys (split without a Python
+    loop) or merge_batches on batches already split with shard_index.
+
+    Reading a key asks the process holding it, use to_dict to read many.
+    Call close (or use a with block) to stop the processes.
+    """
+    def __init__(self, shard_count: int | None = None,
+                 dictionary: Mapping | None = None) -> None:
+        if shard_count is None:
+            shard_count = os.cpu_count() or 1
+        if shard_count < 1:
+            raise ValueError(f"shard_count must be at least 1, "
+                             f"{shard_count=}")
+        self._connections = list()
+        self._processes = list()
+        for _ in range(shard_count):
+            parent_end, child_end = Pipe()
+            process = Process(target=_shard_worker, args=(child_end,),
+                              daemon=True)
+            process.start()
+            child_end.close()
+            self._connections.append(parent_end)
+            self._processes.append(process)
+        if dictionary is not None:
+            self.merge(dictionary, 1)
+
+    def __enter__(self) -> ShardedDict:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __repr__(self):
+        return (f"ShardedDict(shard_count={self.shard_count}, "
+                f"{self.to_dict()})")
+
+    def __getitem__(self, key: any) -> any:
+        found, value = self._ask(self.shard_index(key), "get", key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self) -> Iterator:
+        return chain.from_iterable(self._ask_all("keys"))
+
+    def __len__(self) -> int:
+        return sum(self._ask_all("len"))
+
+    def __contains__(self, key: any) -> bool:
+        return self._ask(self.shard_index(key), "get", key)[0]
+
+    @property
+    def shard_count(self) -> int:
+        return len(self._connections)
+
+    def _check_open(self) -> None:
+        if not self._connections:
+            raise ValueError("ShardedDict is closed")
+
+    def shard_index(self, key: any) -> int:
+        """Returns the index of the shard that holds key, for splitting
+        batches before merge_batches.
+        """
+        self._check_open()
+        return hash(key) % len(self._connections)
+
+    def _ask(self, index: int, *message: any) -> any:
+        self._connections[index].send(message)
+        return self._connections[index].recv()
+
+    def _ask_all(self, *message: any,
+                 indices: Iterable[int] | None = None) -> list:
+        """Sends message to every shard (or the ones at indices) before
+        waiting for any of the answers, so the shards work in parallel.
+        """
+        self._check_open()
+        if indices is None:
+            indices = range(len(self._connections))
+        indices = list(indices)
+        for index in indices:
+            self._connections[index].send(message)
+        return [self._connections[index].recv() for index in indices]
+
+    def _partition(self, key_val: Mapping | Iterable[tuple[any, any]]
+                   ) -> list[tuple[list, list]]:
+        """Splits the pairs into (keys, values) columns per shard, keeping
+        their order.
+        """
+        self._check_open()
+        if isinstance(key_val, Mapping):
+            key_val = key_val.items()
+        shard_count = len(self._connections)
+        batches = [(list(), list()) for _ in range(shard_count)]
+        key_appends = [keys.append for keys, _ in batches]
+        value_appends = [values.append for _, values in batches]
+        for key, value in key_val:
+            index = hash(key) % shard_count
+            key_appends[index](key)
+            value_appends[index](value)
+        return batches
+
+    def _partition_int_array(self, keys: Sequence, values: Sequence
+                             ) -> list[tuple[Sequence, Sequence]] | None:
+        """Splits NumPy integer keys (and their values) per shard without a
+        Python loop, or returns None if the keys are not such an array. For
+        ints with a magnitude below 2 ** 61 - 1 hash(key) is the key itself,
+        apart from hash(-1) which is -2.
+        """
+        import numpy as np
+        if keys.dtype.kind not in "iu" or keys.ndim != 1:
+            return None
+        limit = (1 << 61) - 2
+        if len(keys) and (int(keys.max()) > limit or
+                          int(keys.min()) < -limit):
+            return None
+        shard_count = len(self._connections)
+        shards = np.where(keys == -1, -2, keys) % shard_count
+        order = np.argsort(shards, kind="stable")
+        bounds = np.cumsum(np.bincount(shards, minlength=shard_count))
+        if not isinstance(values, np.ndarray):
+            values = list(values)
+        batches = list()
+        for start, stop in zip(chain([0], bounds[:-1]), bounds):
+            rows = order[start:stop]
+            if isinstance(values, np.ndarray):
+                batches.append((keys[rows], values[rows]))
+            else:
+                batches.append((keys[rows],
+                                [values[row] for row in rows.tolist()]))
+        return batches
+
+    def merge(self, key_val: Mapping | Iterable[tuple[any, any]],
+              condition: int, raise_on_conflict: bool = False) -> list:
+        """Merges the pairs into the shards in parallel, see DictUtils.merge.
+        The conflicting keys are returned grouped by shard rather than in
+        the order of key_val.
+
+        :param key_val: A mapping or an iterable of key/value pairs.
+        :param condition: See DictUtils.add_key_value_list.
+        :param raise_on_conflict: Raise a ValueError instead of returning the
+            conflicts, no shard is changed if it does.
+        :return: The keys which were not merged.
+        """
+        self._check_condition(condition)
+        return self._send_batches(self._partition(key_val), condition,
+                                  raise_on_conflict)
+
+    def merge_columns(self, keys: Sequence, values: Sequence,
+                      condition: int, raise_on_conflict: bool = False
+                      ) -> list:
+        """Like merge but from parallel keys and values columns. NumPy
+        integer keys are split per shard with NumPy, and NumPy or
+        array.array columns are sent to the shards as buffers.
+        """
+        self._check_condition(condition)
+        self._check_open()
+        if len(keys) != len(values):
+            raise ValueError(f"keys and values must be the same length, "
+                             f"{len(keys)=}, {len(values)=}")
+        batches = None
+        if hasattr(keys, "dtype"):
+            batches = self._partition_int_array(keys, values)
+        if batches is None:
+            batches = self._partition(zip(keys, values))
+        return self._send_batches(batches, condition, raise_on_conflict)
+
+    def merge_batches(self, batches: Sequence[tuple[Sequence, Sequence]],
+                      condition: int, raise_on_conflict: bool = False
+                      ) -> list:
+        """Like merge but batches[index] is a (keys, values) pair of columns
+        for shard index, already split with shard_index. Nothing is hashed
+        in this process.
+        """
+        self._check_condition(condition)
+        self._check_open()
+        if len(batches) != len(self._connections):
+            raise ValueError(f"Give one batch per shard, {len(batches)=}, "
+                             f"{self.shard_count=}")
+        return self._send_batches(batches, condition, raise_on_conflict)
+
+    @staticmethod
+    def _check_condition(condition: int) -> None:
+        if condition not in range(5):
+            raise ValueError(f"Not a valid condition, {condition=}, "
+                             f"{type(condition)=}")
+
+    def _send_batches(self, batches: Sequence[tuple[Sequence, Sequence]],
+                      condition: int, raise_on_conflict: bool) -> list:
+        indices = [index for index, (keys, _) in enumerate(batches)
+                   if len(keys)]
+        command = "stage" if raise_on_conflict else "merge"
+        for index in indices:
+            keys, values = batches[index]
+            self._connections[index].send((command, keys, values, condition))
+        conflicts = list(chain.from_iterable(
+            self._connections[index].recv() for index in indices))
+        if raise_on_conflict:
+            command = "discard" if conflicts else "commit"
+            self._ask_all(command, indices=indices)
+            if conflicts:
+                DictUtils._raise_conflicts(conflicts, condition)
+        return conflicts
+
+    def to_dict(self) -> dict:
+        """Returns all the shards as one dict."""
+        dictionary = dict()
+        for shard in self._ask_all("dict"):
+            dictionary.update(shard)
+        return dictionary
+
+    def close(self) -> None:
+        """Stops the shard processes, the shards are lost."""
+        for connection, process in zip(self._connections, self._processes):
+            if process.is_alive():
+                connection.send(("close",))
+            process.join()
+            connection.close()
+        self._connections = list()
+        self._processes = list()
+
 
 if __name__ == "__main__":
     dict_1 = {"a": 1, "b": 2, "c": 3}
@@ -95,3 +585,16 @@ if __name__ == "__main__":
     obj.add_key_value_list([("d", 4), ("c", 6)], 4)
     obj.add_key_value("a", 8, 1)
     print(dict_1)
+    print(obj.merge({"a": 0, "e": 5}, 0))
+    obj.merge([("e", 6), ("f", 7), ("e", 8)], 4)
+    print(dict_1)
+
+    temperatures = MultiMap.group_by(["oslo", "rome", "oslo"],
+                                     [-2.5, 14.0, 1.5], "d")
+    temperatures.merge({"rome": [16.5], "nice": [15.0]})
+    print(temperatures, temperatures.value_count())
+    print(temperatures.to_dict())
+
+    with ShardedDict(4, {"a": 1, "b": [2]}) as sharded:
+        print(sharded.merge([("a", 3), ("b", 4), ("c", 5)], 3))
+        print(sharded, len(sharded), sharded["b"])
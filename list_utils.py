@@ -6,6 +6,11 @@ License: GPL3
 
 from __future__ import annotations
 
+from array import array
+from itertools import chain, compress
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator, Sequence
+
 
 class ListUtils:
     def __init__(self, *lists: list) -> None:
@@ -54,29 +59,130 @@ class ListUtils:
             flattened_lists.append(flat_sub_lists)
         return tuple(flattened_lists)
 
-    def delete_all_instances(self, value: any,
-                             index: list[int, int] | None = None) -> None:
-        """Removes all instances of value from one or more lists. THIS
-        MODIFIES THE INPUTTED LISTS.
-        """
+    def _select_lists(self, index: list[int, int] | None) -> list[list, ...]:
+        """Returns all the lists, or lists[index[0]:index[1]]."""
         if index is None:
-            for sub_list in self._lists:
-                for index, list_value in enumerate(sub_list):
-                    if list_value == value:
-                        del sub_list[index]
-
-        elif (type(index) == list and 1 <= len(index) <= 2 and
-              any(type(val) == int for val in index)) and index[0] <= index[1]:
-            sel_lists = self._lists[index[0]:index[1]]
-            for sub_list in sel_lists:
-                for index, list_value in enumerate(sub_list):
-                    if list_value == value:
-                        del sub_list[index]
-
+            return self._lists
+        elif (type(index) == list and len(index) == 2 and
+              all(type(val) == int for val in index) and
+              index[0] <= index[1]):
+            return self._lists[index[0]:index[1]]
         else:
             raise ValueError(f"Index is not valid, should be list[int, "
                              f"int] or none, {index=}, {type(index)=}")
 
+    def iter_zip_columns(self) -> Iterator[tuple]:
+        """Lazy version of zip_columns, returns an iterator over the
+        tuples instead of a list.
+
+        Precondition
+            All lists given to ListUtils must be the same length.
+        """
+        return zip(*self._lists)
+
+    def iter_unzip_columns(self) -> tuple[tuple[Iterator, ...], ...]:
+        """Lazy version of unzip_columns, each column is an iterator which
+        reads its values from the zipped tuples without copying them.
+
+        Precondition:
+            The number of values in each tuple must all be the same
+        """
+        return tuple(
+            tuple(map(itemgetter(column), zipped)
+                  for column in range(len(zipped[0]) if zipped else 0))
+            for zipped in self._lists
+        )
+
+    def iter_flatten_list(self) -> tuple[Iterator, ...]:
+        """Lazy version of flatten_list, returns an iterator per list."""
+        return tuple(chain.from_iterable(sub_list)
+                     for sub_list in self._lists)
+
+    @staticmethod
+    def _numeric_array(values: list):
+        """Returns values as a NumPy array if they already are a numeric
+        NumPy array, or if they all have the same Python type out of bool,
+        int, float and complex. Otherwise returns None, as NumPy would
+        upcast mixed types (an int past 2 ** 53 next to a float would lose
+        its exact value).
+        """
+        import numpy as np
+        if isinstance(values, np.ndarray):
+            return values if values.dtype.kind in "biufc" else None
+        types = set(map(type, values))
+        if len(types) != 1 or not types <= {bool, int, float, complex}:
+            return None
+        array = np.asarray(values)
+        return array if array.dtype.kind in "biufc" else None
+
+    def zip_columns_np(self):
+        """zip_columns as a single np.column_stack when every list converts
+        to the same numeric dtype, the result is a (length, list count)
+        array. Falls back to zip_columns otherwise.
+
+        Precondition
+            All lists given to ListUtils must be the same length.
+        """
+        import numpy as np
+        arrays = [self._numeric_array(sub_list) for sub_list in self._lists]
+        if (not arrays or any(array is None or array.ndim != 1
+                              for array in arrays) or
+                len({array.dtype for array in arrays}) != 1):
+            return self.zip_columns()
+        return np.column_stack(arrays)
+
+    def flatten_list_np(self) -> tuple:
+        """flatten_list returning a NumPy array for each list whose values
+        are all one numeric type, other lists are returned flattened as in
+        flatten_list. A list given as a NumPy array is flattened with ravel
+        (a view when it can be), lists of tuples are flattened in Python
+        first so this is for getting arrays rather than for speed.
+        """
+        import numpy as np
+        flattened_lists = list()
+        for sub_list in self._lists:
+            if isinstance(sub_list, np.ndarray):
+                flattened_lists.append(sub_list.ravel())
+                continue
+            flattened = list(chain.from_iterable(sub_list))
+            array = self._numeric_array(flattened)
+            flattened_lists.append(flattened if array is None else array)
+        return tuple(flattened_lists)
+
+    def delete_all_instances(self, value: any,
+                             index: list[int, int] | None = None) -> None:
+        """Removes all instances of value from one or more lists in a single
+        pass over each list. THIS MODIFIES THE INPUTTED LISTS.
+        """
+        for sub_list in self._select_lists(index):
+            sub_list[:] = [list_value for list_value in sub_list
+                           if not list_value == value]
+
+    def delete_all_matching(self, values: Iterable | None = None,
+                            predicate: Callable[[any], bool] | None = None,
+                            index: list[int, int] | None = None) -> None:
+        """Removes every value that is in 'values' or for which 'predicate'
+        returns True from one or more lists, in a single pass over each
+        list. THIS MODIFIES THE INPUTTED LISTS.
+
+        Precondition:
+            'values' and the values in the lists are hashable.
+        """
+        if values is None and predicate is None:
+            raise ValueError("Give 'values', 'predicate' or both")
+        value_set = set() if values is None else set(values)
+        for sub_list in self._select_lists(index):
+            if predicate is None:
+                sub_list[:] = [list_value for list_value in sub_list
+                               if list_value not in value_set]
+            elif not value_set:
+                sub_list[:] = [list_value for list_value in sub_list
+                               if not predicate(list_value)]
+            else:
+                sub_list[:] = [list_value for list_value in sub_list
+                               if list_value not in value_set and
+                               not predicate(list_value)]
+
     def display_lists(self) -> None:
         """Prints the lists given to the instance of ListUtils.
 
@@ -103,6 +209,144 @@ class ListUtils:
                              f"If index is a list it must have a range of "
                              f"[0, len(*lists) + 1], {index=}, {type(index)=}")
 
+    def to_columnar(self,
+                    index: list[int, int] | None = None) -> ColumnarLists:
+        """Returns the lists (or lists[index[0]:index[1]]) as a
+        ColumnarLists, the lists are copied.
+        """
+        return ColumnarLists(*self._select_lists(index))
+
+
+class ColumnarLists:
+    """Parallel lists stored as columns of the same length. The length is
+    checked once when the columns are given, after that every operation
+    works on all the columns together.
+
+    Columns of only ints or only floats are stored in array.array, NumPy
+    arrays are kept as they are and everything else is stored in a list.
+    """
+    def __init__(self, *columns: Iterable) -> None:
+        self._columns = [self._store(column) for column in columns]
+        lengths = {len(column) for column in self._columns}
+        if len(lengths) > 1:
+            raise ValueError(f"All columns must be the same length, "
+                             f"lengths={[len(col) for col in self._columns]}")
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def _from_stored(cls, columns: list, length: int) -> ColumnarLists:
+        """Returns a ColumnarLists of already stored columns of 'length'
+        without checking them again.
+        """
+        columnar = cls.__new__(cls)
+        columnar._columns = columns
+        columnar._length = length
+        return columnar
+
+    @staticmethod
+    def _store(column: Iterable) -> Sequence:
+        """Returns the column as an array.array, NumPy array or list."""
+        if isinstance(column, array) or hasattr(column, "dtype"):
+            return column
+        values = list(column)
+        types = set(map(type, values))
+        if types == {float}:
+            return array("d", values)
+        if types == {int}:
+            try:
+                return array("q", values)
+            except OverflowError:
+                pass
+        return values
+
+    @staticmethod
+    def _take_column(column: Sequence, indices: list[int]) -> Sequence:
+        """Returns the values of column at indices, in the same storage."""
+        if isinstance(column, array):
+            return array(column.typecode, map(column.__getitem__, indices))
+        if isinstance(column, list):
+            return list(map(column.__getitem__, indices))
+        return column[indices]
+
+    def __repr__(self):
+        return (f"ColumnarLists"
+                f"({', '.join([str(col) for col in self.to_lists()])})")
+
+    def __str__(self):
+        return f"<{len(self._columns)} columns of length {self._length}>"
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> Sequence:
+        return self._columns[index]
+
+    @property
+    def column_count(self) -> int:
+        return len(self._columns)
+
+    def column(self, index: int) -> Sequence:
+        """Returns the column at index without copying it."""
+        return self._columns[index]
+
+    def row(self, index: int) -> tuple:
+        """Returns the values at index in every column."""
+        return tuple(column[index] for column in self._columns)
+
+    def iter_rows(self) -> Iterator[tuple]:
+        return zip(*self._columns)
+
+    def take(self, indices: Iterable[int]) -> ColumnarLists:
+        """Returns a new ColumnarLists of the rows at indices, in that
+        order. The same indices are applied to every column.
+        """
+        indices = list(indices)
+        return self._from_stored(
+            [self._take_column(column, indices) for column in self._columns],
+            len(indices))
+
+    def compress(self, mask: Iterable[bool]) -> ColumnarLists:
+        """Returns a new ColumnarLists of the rows where mask is True."""
+        mask = list(mask)
+        if len(mask) != self._length:
+            raise ValueError(f"mask must be the same length as the columns, "
+                             f"{len(mask)=}, {self._length=}")
+        return self.take(compress(range(self._length), mask))
+
+    def filter(self, predicate: Callable[[any], bool],
+               column: int = 0) -> ColumnarLists:
+        """Returns a new ColumnarLists of the rows where predicate returns
+        True for the value in 'column'.
+        """
+        return self.compress(map(predicate, self._columns[column]))
+
+    def sort_by(self, column: int = 0,
+                key: Callable[[any], any] | None = None,
+                reverse: bool = False) -> ColumnarLists:
+        """Returns a new ColumnarLists sorted by the values in 'column'.
+        The sort is stable and a single permutation is applied to every
+        column.
+        """
+        values = self._columns[column]
+        if key is None and not reverse and hasattr(values, "dtype"):
+            import numpy as np
+            return self.take(np.argsort(values, kind="stable").tolist())
+        if key is None:
+            order_key = values.__getitem__
+        else:
+            def order_key(row_index: int) -> any:
+                return key(values[row_index])
+        return self.take(sorted(range(self._length), key=order_key,
+                                reverse=reverse))
+
+    def to_lists(self) -> tuple[list, ...]:
+        """Returns the columns as lists."""
+        return tuple(list(column) if isinstance(column, list)
+                     else column.tolist() for column in self._columns)
+
+    def to_list_utils(self) -> ListUtils:
+        return ListUtils(*self.to_lists())
+
 
 if __name__ == '__main__':
     # print(ListUtils([(1, 6), (2, 7), (3, 8), (4, 9), (5, 0)],
@@ -118,3 +362,14 @@ if __name__ == '__main__':
     print(bleh.get_lists([0, 1]))
     print(bleh.get_lists([0, 2]))
     print(bleh.get_lists(0))
+
+    zipped = ListUtils([1.5, 2.0, 3.0], [4.5, 5.0, 6.0])
+    print(list(zipped.iter_zip_columns()))
+    print(zipped.zip_columns_np())
+    print(ListUtils([(1, 6), (2, 7)]).flatten_list_np())
+
+    columnar = ListUtils([3, 1, 2], [0.3, 0.1, 0.2], ["c", "a", "b"]
+                         ).to_columnar()
+    print(columnar, repr(columnar))
+    print(repr(columnar.sort_by(0)))
+    print(repr(columnar.filter(lambda value: value > 1)))
@@ -4,7 +4,18 @@ Alexander Bürow - 13 October 2023
 License: GPL3
 """
 
+from __future__ import annotations
+
+from fractions import Fraction
 import decimal
+import itertools
+import math
+import numbers
+
+# Additions and multiplications of finite Decimals are exact in this
+# context, so a term is never rounded before it is converted to a float.
+_EXACT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX,
+                         Emin=decimal.MIN_EMIN)
 
 
 class Range:
@@ -17,6 +28,10 @@ class Range:
     start defaults to 0, and stop is omitted! range(4) produces 0, 1, 2, 3.
     These are exactly the valid indices for a list of 4 elements.
     When step is given, it specifies the increment (or decrement).
+
+    Each term is start + index * step computed exactly and then rounded to
+    round_length decimal places, so len(), indexing, slicing, membership,
+    index() and count() are all O(1).
     """
 
     def __init__(self, *args: float | int) -> None:
@@ -43,16 +58,155 @@ class Range:
         self.stop = decimal.Decimal(args[0] if len(args) == 1 else args[1])
         self.step = decimal.Decimal(args[2] if len(args) == 3 else 1)
         self.round_length = len(str(float(self.step))) - 2
+        self.tolerance = 1e-9
+        self._length = self._calc_length()
+
+    @classmethod
+    def _from_decimals(cls, start: decimal.Decimal, stop: decimal.Decimal,
+                       step: decimal.Decimal, round_length: int) -> Range:
+        """Creates a Range from exact Decimals without validating them, used
+        for slices (which may be empty).
+        """
+        new_range = cls.__new__(cls)
+        new_range.start = start
+        new_range.stop = stop
+        new_range.step = step
+        new_range.round_length = round_length
+        new_range.tolerance = 1e-9
+        new_range._length = new_range._calc_length()
+        return new_range
+
+    def _calc_length(self) -> int:
+        """Returns the number of terms, ceil((stop - start) / step)."""
+        span = Fraction(self.stop) - Fraction(self.start)
+        return max(0, math.ceil(span / Fraction(self.step)))
+
+    def _term(self, index: int) -> decimal.Decimal:
+        """Returns the exact value of start + index * step."""
+        return _EXACT.add(self.start, _EXACT.multiply(self.step, index))
 
     def __iter__(self):
         """Yields the next element in the sequence given by start+step, where
         start is the previous element in the sequence.
         """
-        current = self.start
-        while ((self.step > 0 and current < self.stop) or
-               (self.step < 0 and current > self.stop)):
-            yield round(float(current), self.round_length)
-            current += self.step
+        current, step, round_length = self.start, self.step, self.round_length
+        add = _EXACT.add
+        for _ in range(self._length):
+            yield round(float(current), round_length)
+            current = add(current, step)
+
+    def __reversed__(self):
+        """Yields the elements from last to first."""
+        current, step, round_length = (self._term(self._length - 1),
+                                       self.step, self.round_length)
+        subtract = _EXACT.subtract
+        for _ in range(self._length):
+            yield round(float(current), round_length)
+            current = subtract(current, step)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int | slice) -> float | Range:
+        """Returns the element at index, or a new Range for a slice.
+
+        Parameters:
+            index (int | slice): The index (negative indices count from the
+                end) or slice, the same as for range.
+        """
+        if isinstance(index, slice):
+            indices = range(self._length)[index]
+            return self._from_decimals(
+                self._term(indices.start), self._term(indices.stop),
+                _EXACT.multiply(self.step, indices.step), self.round_length)
+        if not isinstance(index, int):
+            raise TypeError(f"Range indices must be integers or slices, not "
+                            f"{type(index).__name__}")
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Range object index out of range")
+        return round(float(self._term(index)), self.round_length)
+
+    def __contains__(self, value: object) -> bool:
+        try:
+            self.index(value)
+        except ValueError:
+            return False
+        return True
+
+    def index(self, value: float | int, tolerance: float | None = None
+              ) -> int:
+        """Returns the index of the element equal to value.
+
+        Parameters:
+            value (float | int): The value to look for.
+            tolerance (float | None): How far value may be from an element,
+                defaults to the tolerance attribute (1e-9).
+        """
+        if tolerance is None:
+            tolerance = self.tolerance
+        # Fraction would also parse strings such as "0.5".
+        if not isinstance(value, (numbers.Real, decimal.Decimal)):
+            raise ValueError(f"{value!r} is not in Range")
+        try:
+            position = ((Fraction(value) - Fraction(self.start)) /
+                        Fraction(self.step))
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"{value!r} is not in Range") from None
+        nearest = int(round(position))
+        for index in (nearest, nearest - 1, nearest + 1):
+            if (0 <= index < self._length and
+                    abs(self[index] - float(value)) <= tolerance):
+                return index
+        raise ValueError(f"{value!r} is not in Range")
+
+    def count(self, value: float | int) -> int:
+        """Returns the number of elements equal to value (0 or 1)."""
+        return int(value in self)
+
+    def _block(self, first: int, last: int):
+        """Returns elements first to last (exclusive) as a float64 array,
+        bit-identical to indexing them one at a time.
+
+        Each element is round(start + i * step, round_length), computed as
+        rint(value * 10 ** round_length) / 10 ** round_length. That matches
+        the scalar round() unless value * 10 ** round_length is close to
+        a .5 tie or to 0, so those few elements are recomputed exactly.
+        Ranges too large for float64 to resolve their last decimal place
+        are computed element by element.
+        """
+        import numpy as np
+        scale = 10.0 ** self.round_length
+        bound = max(abs(self._term(first)), abs(self._term(last)))
+        if not 0 <= self.round_length <= 22 or float(bound) * scale >= 2 ** 40:
+            return np.fromiter((self[index] for index in range(first, last)),
+                               dtype=np.float64, count=last - first)
+        indices = np.arange(first, last, dtype=np.float64)
+        scaled = (float(self.start) + indices * float(self.step)) * scale
+        block = np.rint(scaled) / scale
+        # Ties, and values near 0 whose sign decides between 0.0 and -0.0.
+        inexact = ((np.abs(scaled - np.floor(scaled) - 0.5) < 1e-3) |
+                   (np.abs(scaled) < 1e-3))
+        for offset in np.flatnonzero(inexact).tolist():
+            block[offset] = self[first + offset]
+        return block
+
+    def to_numpy(self):
+        """Returns every element as a float64 NumPy array."""
+        return self._block(0, self._length)
+
+    def iter_chunks(self, chunk_size: int = 65536):
+        """Yields the elements as float64 NumPy arrays of chunk_size
+        elements (the last may be shorter).
+
+        Parameters:
+            chunk_size (int): The number of elements per array.
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, {chunk_size=}")
+        for first in range(0, self._length, chunk_size):
+            yield self._block(first, min(first + chunk_size, self._length))
 
     def __repr__(self) -> str:
         if self.step == 1.0 and self.start == 0.0:
@@ -99,3 +253,149 @@ class Range:
             raise ValueError(f"Invalid conditions, step must be {value} given "
                              f"the start ({inputs[0]}) and stop ({inputs[1]}).")
 
+
+class RangeND:
+    """
+    RangeND(*ranges) -> grid object
+
+    Return an object that produces every point of the grid spanned by the
+    given Range objects as a tuple of floats, in the same order as
+    itertools.product (the last Range changes fastest). Nothing is
+    materialised, a point is found from its flat index in O(ndim).
+    """
+
+    def __init__(self, *ranges: Range) -> None:
+        """Initialises the grid from one or more Range objects.
+
+        Parameters:
+            ranges (Range): The values along each axis of the grid.
+        """
+        if not ranges:
+            raise ValueError("RangeND needs at least one Range.")
+        for axis, axis_range in enumerate(ranges):
+            if not isinstance(axis_range, Range):
+                raise ValueError(f"axis {axis} is not type Range, "
+                                 f"type(axis)={type(axis_range)}")
+        self.ranges = tuple(ranges)
+        self.shape = tuple(len(axis_range) for axis_range in ranges)
+        self._length = math.prod(self.shape)
+        self._strides = tuple(math.prod(self.shape[axis + 1:])
+                              for axis in range(len(self.shape)))
+
+    def __iter__(self):
+        return itertools.product(*self.ranges)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: int) -> tuple[float, ...]:
+        """Returns the point at a flat index (negative indices count from
+        the end).
+        """
+        if not isinstance(index, int):
+            raise TypeError(f"RangeND indices must be integers, not "
+                            f"{type(index).__name__}")
+        if index < 0:
+            index += self._length
+        return tuple(axis_range[axis_index] for axis_range, axis_index in
+                     zip(self.ranges, self.unravel(index)))
+
+    def __contains__(self, point: object) -> bool:
+        try:
+            return (len(point) == len(self.ranges) and
+                    all(value in axis_range for value, axis_range in
+                        zip(point, self.ranges)))
+        except TypeError:
+            return False
+
+    def __repr__(self) -> str:
+        axes = ", ".join(repr(axis_range) for axis_range in self.ranges)
+        return f"{self.__class__.__name__}({axes})"
+
+    def unravel(self, index: int) -> tuple[int, ...]:
+        """Returns the index along each axis of a flat index."""
+        if not 0 <= index < self._length:
+            raise IndexError("RangeND object index out of range")
+        indices = list()
+        for stride in self._strides:
+            axis_index, index = divmod(index, stride)
+            indices.append(axis_index)
+        return tuple(indices)
+
+    def ravel(self, indices: tuple[int, ...]) -> int:
+        """Returns the flat index of a tuple of per-axis indices."""
+        if len(indices) != len(self.shape) or not all(
+                0 <= axis_index < length
+                for axis_index, length in zip(indices, self.shape)):
+            raise IndexError(f"indices {indices} out of range for shape "
+                             f"{self.shape}")
+        return sum(axis_index * stride
+                   for axis_index, stride in zip(indices, self._strides))
+
+    def _block(self, first: int, last: int, axes: list):
+        import numpy as np
+        flat = np.arange(first, last, dtype=np.int64)
+        block = np.empty((last - first, len(self.shape)), dtype=np.float64)
+        for axis, stride in enumerate(self._strides):
+            axis_index, flat = np.divmod(flat, stride)
+            block[:, axis] = axes[axis][axis_index]
+        return block
+
+    def to_numpy(self):
+        """Returns every point as a (len, ndim) float64 NumPy array."""
+        return self._block(0, self._length, [axis_range.to_numpy()
+                                             for axis_range in self.ranges])
+
+    def iter_blocks(self, chunk_size: int = 65536):
+        """Yields the points as (chunk_size, ndim) float64 NumPy arrays (the
+        last may be shorter), in flat index order.
+
+        Parameters:
+            chunk_size (int): The number of points per array.
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, {chunk_size=}")
+        axes = [axis_range.to_numpy() for axis_range in self.ranges]
+        for first in range(0, self._length, chunk_size):
+            yield self._block(first, min(first + chunk_size, self._length),
+                              axes)
+
+    def split(self, parts: int) -> list[RangeND]:
+        """Splits the grid into disjoint sub-grids which together cover it,
+        e.g. to hand one to each worker process.
+
+        The first axis is split if it is long enough, so each sub-grid is
+        also a contiguous block of flat indices, otherwise the longest axis
+        is split. Fewer than 'parts' sub-grids are returned if that axis
+        is shorter than 'parts'.
+
+        Parameters:
+            parts (int): The number of sub-grids wanted.
+        """
+        if parts < 1:
+            raise ValueError(f"parts must be at least 1, {parts=}")
+        axis = (0 if self.shape[0] >= parts else
+                self.shape.index(max(self.shape)))
+        length = self.shape[axis]
+        parts = max(1, min(parts, length))
+        bounds = [length * part // parts for part in range(parts + 1)]
+        return [
+            RangeND(*self.ranges[:axis],
+                    self.ranges[axis][bounds[part]:bounds[part + 1]],
+                    *self.ranges[axis + 1:])
+            for part in range(parts)
+        ]
+
+
+if __name__ == "__main__":
+    tenths = Range(0, 1, 0.1)
+    print(tenths, list(tenths), len(tenths))
+    print(tenths[3], tenths[-1], tenths[2:8:2], list(tenths[::-1]))
+    print(0.3 in tenths, 0.1 + 0.2 in tenths, 0.35 in tenths)
+    print(tenths.index(0.7), tenths.count(1.0))
+    print(tenths.to_numpy(), [chunk.size for chunk in tenths.iter_chunks(4)])
+
+    grid = RangeND(Range(0, 1, 0.5), Range(3), Range(-1, 1, 0.25))
+    print(grid, len(grid), grid.shape, grid[13], grid.unravel(13),
+          grid.ravel((0, 1, 5)), (0.5, 2.0, 0.75) in grid)
+    print([len(sub_grid) for sub_grid in grid.split(4)])